@@ -1,27 +1,186 @@
+import atexit
+import base64
 import click
+import contextlib
+import cProfile
+import datetime
+import functools
+import hashlib
+import heapq
+import io
+import itertools
 import json
-from flask import Flask, Blueprint, Response, request
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from urllib.parse import urlencode
+from flask import (
+    Flask, Blueprint, Response, current_app, g, has_request_context, jsonify,
+    request, stream_with_context
+)
 from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Resource, Api
-from jsonschema import validate, ValidationError
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy import (
+    Column, Integer, MetaData, PrimaryKeyConstraint, String, Table, bindparam, case,
+    cast, delete, event, func, inspect, insert, literal, or_, select, text, update
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declared_attr
 from sqlalchemy.exc import IntegrityError, OperationalError
-
-app = Flask(__name__, static_folder="static")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///development.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date, quote_etag
+from werkzeug.local import LocalProxy
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# SQLite storage profiles: PRAGMAs applied to every new connection, and
+# SQLAlchemy engine options. "stock" only enables foreign keys, "wal" lets
+# readers run alongside a writer, and "tuned" also grows the page cache,
+# memory maps the database file and waits for locks instead of failing.
+SQLITE_PROFILES = {
+    "stock": {
+        "pragmas": {"foreign_keys": "ON"},
+        "engine": {},
+    },
+    "wal": {
+        "pragmas": {
+            "foreign_keys": "ON",
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+        },
+        "engine": {},
+    },
+    "tuned": {
+        "pragmas": {
+            "foreign_keys": "ON",
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -64000,
+            "mmap_size": 256 * 1024 * 1024,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+        "engine": {"pool_size": 10, "max_overflow": 20, "pool_timeout": 10},
+    },
+}
+
+# Pool settings for server databases, where every worker process keeps its
+# own pool. pre_ping and recycle drop connections the server has closed.
+SERVER_ENGINE_OPTIONS = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 10,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+}
+
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///development.db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "SQLITE_PROFILE": "tuned",
+    "PARTITION_MEASUREMENTS": False,
+    "RESPONSE_CACHE_MAX_BYTES": 32 * 1024 * 1024,
+    "INGEST_WRITE_BEHIND": False,
+    "INGEST_QUEUE_ROWS": 100000,
+    "INGEST_FLUSH_ROWS": 5000,
+    "INGEST_FLUSH_INTERVAL": 0.05,
+    "MASON_ENCODER": "auto",
+    "SERVER_TIMING": True,
+    "PROFILE_SAMPLE_RATE": 0.0,
+    "PROFILE_SLOWEST": 20,
+    "PROFILE_DIR": None,
+    "SUBSCRIPTION_KEEPALIVE": 15.0,
+    "SUBSCRIPTION_HISTORY": 256,
+    "ASGI_FALLBACK_THREADS": 64,
+    "ASGI_DB_CONNECTIONS": 4,
+}
+
+db = SQLAlchemy()
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
+site_bp = Blueprint("site", __name__)
+response_cache = LocalProxy(lambda: current_app.extensions["sensorhub"]["response_cache"])
+ingest_queue = LocalProxy(lambda: current_app.extensions["sensorhub"]["ingest_queue"])
+request_metrics = LocalProxy(lambda: current_app.extensions["sensorhub"]["metrics"])
+slowest_profiles = LocalProxy(lambda: current_app.extensions["sensorhub"]["profiles"])
+measurement_hub = LocalProxy(lambda: current_app.extensions["sensorhub"]["hub"])
 
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
+NPY = "application/x-npy"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+EVENT_STREAM = "text/event-stream"
 LINK_RELATIONS_URL = "/sensorhub/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 SENSOR_PROFILE = "/profiles/sensor/"
 
 MEASUREMENT_PAGE_SIZE = 50
+MEASUREMENT_INSERT_CHUNK = 1000
+STREAM_BATCH_SIZE = 500
+MAX_AGGREGATE_BUCKETS = 10000
+MAX_BATCH_OPERATIONS = 1000
+ROLLUP_REBUILD_CHUNK = 50000
+INGEST_RETRIES = 3
+INGEST_RETRY_DELAY = 0.1
+EXPORT_BATCH_SIZE = 65536
+TESTGEN_CHUNK = 100000
+TESTGEN_DISTRIBUTIONS = ["uniform", "normal", "walk", "daily"]
+EPOCH = datetime.datetime(1970, 1, 1)
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+AGGREGATE_METHODS = {
+    "stats": None,
+    "median": 0.5,
+    "p90": 0.9,
+    "p95": 0.95,
+    "p99": 0.99,
+}
+
+def set_sqlite_pragma(dbapi_connection, connection_record, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_statements = g.get("sql_statements", 0) + 1
+        if context is not None:
+            context.sensorhub_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def time_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "sensorhub_started", None)
+    if started is not None:
+        record_span("db", time.perf_counter() - started)
 
 # ^
 # |
@@ -32,7 +191,8 @@ MEASUREMENT_PAGE_SIZE = 50
 
 deployments = db.Table("deployments",
     db.Column("deployment_id", db.Integer, db.ForeignKey("deployment.id"), primary_key=True),
-    db.Column("sensor_id", db.Integer, db.ForeignKey("sensor.id"), primary_key=True)
+    db.Column("sensor_id", db.Integer, db.ForeignKey("sensor.id"), primary_key=True),
+    db.Index("ix_deployments_sensor_id", "sensor_id")
 )
 
 class Location(db.Model):
@@ -64,6 +224,7 @@ class Sensor(db.Model):
     deployments = db.relationship("Deployment", secondary=deployments, back_populates="sensors")
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_schema():
         schema = {
             "type": "object",
@@ -87,8 +248,13 @@ class Measurement(db.Model):
     time = db.Column(db.DateTime, nullable=False)
         
     sensor = db.relationship("Sensor", back_populates="measurements")
+
+    __table_args__ = (
+        db.Index("ix_measurement_sensor_time_id", "sensor_id", "time", "id"),
+    )
     
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_schema():
         schema = {
             "type": "object",
@@ -106,6 +272,123 @@ class Measurement(db.Model):
         }
         return schema
 
+class RollupMixin(object):
+    """
+    Columns shared by the measurement rollup tables. Each row summarizes one
+    sensor's measurements in one bucket of the table's resolution, and the
+    bucket is identified by its start time in seconds since the epoch.
+    """
+
+    @declared_attr
+    def sensor_id(cls):
+        return db.Column(
+            db.Integer, db.ForeignKey("sensor.id", ondelete="CASCADE"), primary_key=True
+        )
+
+    bucket = db.Column(db.Integer, primary_key=True)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+    sum = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+class MinuteRollup(RollupMixin, db.Model):
+    resolution = 60
+
+class HourRollup(RollupMixin, db.Model):
+    resolution = 3600
+
+class DayRollup(RollupMixin, db.Model):
+    resolution = 86400
+
+# coarsest first, which is the order aggregate queries try them in
+ROLLUPS = [DayRollup, HourRollup, MinuteRollup]
+
+class TableVersion(db.Model):
+    table = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime, nullable=False)
+
+def bump_table_versions(connection, tables):
+    """
+    Increments the write counters of the given tables in the transaction of
+    the given connection. Counter rows are created by the same statement if
+    they do not exist yet, so concurrent first writes do not conflict.
+    """
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+    versions = TableVersion.__table__
+    statement = UPSERT_INSERTS[connection.dialect.name](versions).values([
+        {"table": name, "version": 1, "modified": now} for name in sorted(tables)
+    ])
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[versions.c.table],
+        set_={"version": versions.c.version + 1, "modified": statement.excluded.modified}
+    ))
+
+def measurement_version_name(sensor_id):
+    return "measurement:{}".format(sensor_id)
+
+def sensor_measurement_version(sensor):
+    """
+    Returns an SQL expression for the name of the measurement write counter
+    of the sensor with the given name, for versions_statement.
+    """
+
+    return literal("measurement:").concat(cast(
+        select(Sensor.id).where(Sensor.name == sensor).scalar_subquery(), String
+    ))
+
+def version_names(table, sensor_ids=None):
+    """
+    Returns the names of the write counters to bump for a write to a table.
+    Measurement writes that are known to touch only some sensors bump one
+    counter per sensor, so that writers of different sensors do not wait on
+    the same counter row and the validators of other sensors stay valid.
+    Other writes bump the counter of the table.
+
+    : param Table table: the table written to
+    : param iterable sensor_ids: sensor ids of the written measurements
+    """
+
+    if table.name != Measurement.__tablename__ or sensor_ids is None:
+        return {table.name}
+    sensor_ids = set(sensor_ids)
+    if None in sensor_ids:
+        return {table.name}
+    return {measurement_version_name(sensor_id) for sensor_id in sensor_ids}
+
+def written_version_names(obj):
+    if isinstance(obj, Measurement):
+        history = inspect(obj).attrs.sensor_id.history
+        return version_names(obj.__table__, [obj.sensor_id] + list(history.deleted))
+    return {obj.__table__.name}
+
+@event.listens_for(db.session, "after_flush")
+def bump_flushed_table_versions(session, flush_context):
+    tables = set()
+    for obj in session.new | session.deleted:
+        tables |= written_version_names(obj)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            tables |= written_version_names(obj)
+    if tables:
+        bump_table_versions(session.connection(), tables)
+
+@event.listens_for(db.session, "do_orm_execute")
+def bump_executed_table_versions(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = orm_execute_state.statement.table
+        if table.name != TableVersion.__tablename__:
+            params = orm_execute_state.parameters
+            if isinstance(params, dict):
+                params = [params]
+            sensor_ids = None
+            if orm_execute_state.is_insert and params and all("sensor_id" in row for row in params):
+                sensor_ids = [row["sensor_id"] for row in params]
+            bump_table_versions(
+                orm_execute_state.session.connection(), version_names(table, sensor_ids)
+            )
+
 # ^
 # |
 # MODELS
@@ -177,58 +460,81 @@ class MasonBuilder(dict):
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
 
+    def iter_json(self, items, key="items"):
+        """
+        Serializes the object as JSON in pieces, followed by an array of items
+        under the given key. The items are consumed one at a time, so they can
+        come from a generator over a database cursor without the whole
+        collection ever being in memory at once. Meant to be passed to a
+        streaming Response.
+
+        : param iterable items: JSON serializable items for the array
+        : param str key: property name for the array
+        """
+
+        encode = mason_encoder()
+        started = time.perf_counter()
+        head = encode(self)
+        serializing = time.perf_counter() - started
+        yield head[:-1]
+        yield '{}"{}":['.format("," if self else "", key).encode("utf-8")
+        separator = b""
+        for item in items:
+            started = time.perf_counter()
+            if isinstance(item, MasonRecord):
+                chunk = separator + item.to_json(encode)
+            else:
+                chunk = separator + encode(item)
+            serializing += time.perf_counter() - started
+            yield chunk
+            separator = b","
+        record_span("serialize", serializing)
+        yield b"]}"
+
 
 class SensorhubBuilder(MasonBuilder):
 
+    def add_control_template(self, key, **values):
+        """
+        Adds a control from the control template registry. Only the href is
+        generated here, from the given URL variables; everything else is
+        shared with every other use of the template.
+
+        : param str key: registry key of the template
+        """
+
+        template = control_template(key)
+        if "@controls" not in self:
+            self["@controls"] = {}
+
+        self["@controls"][template.ctrl_name] = template.control(**values)
+
     def add_control_delete_sensor(self, sensor):
-        self.add_control(
-            "senhub:delete",
-            api.url_for(SensorItem, sensor=sensor),
-            method="DELETE",
-            title="Delete this sensor"
-        )
+        self.add_control_template("delete-sensor", sensor=sensor)
 
     def add_control_add_measurement(self, sensor):
-        self.add_control(
-            "senhub:add-measurement",
-            api.url_for(MeasurementCollection, sensor=sensor),
-            method="POST",
-            encoding="json",
-            title="Add a new measurement for this sensor",
-            schema=Measurement.get_schema()
-        )
+        self.add_control_template("add-measurement", sensor=sensor)
 
     def add_control_add_sensor(self):
-        self.add_control(
-            "senhub:add-sensor",
-            api.url_for(SensorCollection),
-            method="POST",
-            encoding="json",
-            title="Add a new sensor",
-            schema=Sensor.get_schema()
-        )
+        self.add_control_template("add-sensor")
+
+    def add_control_subscribe(self, sensor):
+        self.add_control_template("subscribe", sensor=sensor)
+
+    def add_control_batch_sensors(self):
+        self.add_control_template("batch-sensors")
 
     def add_control_modify_sensor(self, sensor):
-        self.add_control(
-            "edit",
-            api.url_for(SensorItem, sensor=sensor),
-            method="PUT",
-            encoding="json",
-            title="Edit this sensor",
-            schema=Sensor.get_schema()
-        )
+        self.add_control_template("modify-sensor", sensor=sensor)
 
     def add_control_get_measurements(self, sensor):
-        base_uri = api.url_for(MeasurementCollection, sensor=sensor)
-        uri = base_uri + "?start={index}"
-        self.add_control(
-            "senhub:measurements",
-            uri,
-            isHrefTemplate=True,
-            schema=self._paginator_schema()
-        )
+        self.add_control_template("get-measurements", sensor=sensor)
+
+    def add_control_aggregate_measurements(self, sensor):
+        self.add_control_template("aggregate-measurements", sensor=sensor)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _paginator_schema():
         schema = {
             "type": "object",
@@ -241,243 +547,3095 @@ class SensorhubBuilder(MasonBuilder):
             "type": "integer",
             "default": "0"
         }
+        props["from"] = {
+            "description": "Only measurements taken at or after this time",
+            "type": "string",
+            "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]T[0-9]{2}:[0-5][0-9]:[0-5][0-9]Z$"
+        }
+        props["to"] = {
+            "description": "Only measurements taken before this time",
+            "type": "string",
+            "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]T[0-9]{2}:[0-5][0-9]:[0-5][0-9]Z$"
+        }
         return schema
 
-def create_error_response(status_code, title, message=None):
-    resource_url = request.path
-    body = MasonBuilder(resource_url=resource_url)
-    body.add_error(title, message)
-    body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _batch_schema():
+        return {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": MAX_BATCH_OPERATIONS,
+            "items": SensorBatch.get_schema()
+        }
 
-# ^
-# |
-# UTILS
-# RESOURCES
-# |
-# v
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _aggregate_schema():
+        schema = {
+            "type": "object",
+            "properties": {},
+            "required": ["start", "end"]
+        }
+        props = schema["properties"]
+        props["start"] = {
+            "description": "Start of the time window (inclusive)",
+            "type": "string",
+            "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]T[0-9]{2}:[0-5][0-9]:[0-5][0-9]Z$"
+        }
+        props["end"] = {
+            "description": "End of the time window (exclusive)",
+            "type": "string",
+            "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]T[0-9]{2}:[0-5][0-9]:[0-5][0-9]Z$"
+        }
+        props["bucket"] = {
+            "description": "Bucket size as a number and a unit (s, m, h or d), e.g. 1m or 1h",
+            "type": "string",
+            "pattern": "^[1-9][0-9]*[smhd]$",
+            "default": "1h"
+        }
+        props["method"] = {
+            "description": "stats for min/max/avg/count, or median, p90, p95 or p99",
+            "type": "string",
+            "enum": list(AGGREGATE_METHODS),
+            "default": "stats"
+        }
+        return schema
 
-class SensorCollection(Resource):
+class RecordTemplate(object):
+    """
+    The shape shared by the items of a collection: their field names and the
+    namespaces and controls every item has. Items are then stored compactly
+    as MasonRecords holding only their field values and per item hrefs, and
+    are turned into JSON only when serialized.
 
-    def get(self):
-        body = SensorhubBuilder()
+    Controls added without an href get theirs from each record, controls
+    added with one are the same for every item.
+    """
 
-        body.add_namespace("senhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(SensorCollection))
-        body.add_control_add_sensor()
-        body["items"] = []
-        for db_sensor in Sensor.query.all():
-            item = SensorhubBuilder(
-                name=db_sensor.name,
-                model=db_sensor.model,
-                location=db_sensor.location and db_sensor.location.name
-            )
-            item.add_control("self", api.url_for(SensorItem, sensor=db_sensor.name))
-            item.add_control("profile", SENSOR_PROFILE)
-            body["items"].append(item)
+    def __init__(self, *fields):
+        self.fields = fields
+        self.namespaces = {}
+        self.controls = {}
+        self.href_slots = {}
+        self._segments = {}
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+    def add_namespace(self, ns, uri):
+        self.namespaces[ns] = {"name": uri}
+        self._segments.clear()
 
-    def post(self):
-        if not request.json:
-            return create_error_response(415, "Unsupported media type",
-                "Requests must be JSON"
-            )
+    def add_control(self, ctrl_name, href=None, **kwargs):
+        self.controls[ctrl_name] = (href, kwargs)
+        if href is None:
+            self.href_slots[ctrl_name] = len(self.href_slots)
+        self._segments.clear()
 
-        try:
-            validate(request.json, Sensor.get_schema())
-        except ValidationError as e:
-            return create_error_response(400, "Invalid JSON document", str(e))
+    def record(self, *values):
+        return MasonRecord(self, values)
 
-        sensor = Sensor(
-            name=request.json["name"],
-            model=request.json["model"],
-        )
+    def expand(self, values, hrefs):
+        """
+        Builds the full Mason object for the given field values and per item
+        hrefs, with its members in the order a MasonBuilder would have them.
+        """
 
-        try:
-            db.session.add(sensor)
-            db.session.commit()
-        except IntegrityError:
-            return create_error_response(409, "Already exists", 
-                "Sensor with name '{}' already exists.".format(request.json["name"])
-            )
+        obj = dict(zip(self.fields, values))
+        if self.namespaces:
+            obj["@namespaces"] = self.namespaces
+        if self.controls:
+            controls = obj["@controls"] = {}
+            for ctrl_name, (href, kwargs) in self.controls.items():
+                if href is None:
+                    href = hrefs[self.href_slots[ctrl_name]]
+                control = controls[ctrl_name] = dict(kwargs)
+                control["href"] = href
+        return obj
+
+    def segments(self, encode):
+        """
+        Returns the encoded form of the template as the constant byte strings
+        that go between the encoded values of a record: the first before the
+        first field value, the last after the last href. Computed once per
+        encoder by encoding a skeleton with marker values and splitting it at
+        the markers.
+        """
 
-        return Response(status=201, headers={
-            "Location": api.url_for(SensorItem, sensor=request.json["name"])
-        })
+        segments = self._segments.get(encode)
+        if segments is None:
+            markers = ["\x00{}\x00".format(i) for i in range(len(self.fields) + len(self.href_slots))]
+            data = encode(self.expand(markers, markers[len(self.fields):]))
+            segments = []
+            for marker in markers:
+                head, data = data.split(encode(marker), 1)
+                segments.append(head)
+            segments.append(data)
+            self._segments[encode] = segments
+        return segments
 
 
-class SensorItem(Resource):
+class MasonRecord(object):
+    """
+    A compact collection item: the field values and per item control hrefs
+    of an object whose shape is described by a RecordTemplate. It supports
+    the same add_control and add_namespace calls as MasonBuilder. Anything
+    the template does not cover is kept in a MasonBuilder on the side, and
+    such records are encoded by expanding them in full.
+    """
 
-    def get(self, sensor):
-        db_sensor = Sensor.query.filter_by(name=sensor).first()
-        if db_sensor is None:
-            return create_error_response(404, "Not found", 
-                "No sensor was found with the name {}".format(sensor)
-            )
-        
-        body = SensorhubBuilder(
-            name=db_sensor.name,
-            model=db_sensor.model,
-            location=db_sensor.location and db_sensor.location.name
-        )
-        body.add_namespace("senhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(SensorItem, sensor=sensor))
-        body.add_control("profile", SENSOR_PROFILE)
-        body.add_control("collection", api.url_for(SensorCollection))
-        body.add_control_delete_sensor(sensor)
-        body.add_control_modify_sensor(sensor)
-        body.add_control_add_measurement(sensor)
-        body.add_control_get_measurements(sensor)
-        body.add_control("senhub:measurements-first",
-            api.url_for(MeasurementCollection, sensor=sensor)
-        )
-        if db_sensor.location is not None:
-            body.add_control("senhub:location", 
-                api.url_for(LocationItem, location=db_sensor.location.sensor)
-            )
-        
-        return Response(json.dumps(body), 200, mimetype=MASON)
-    
-    def put(self, sensor):
-        db_sensor = Sensor.query.filter_by(name=sensor).first()
-        if db_sensor is None:
-            return create_error_response(404, "Not found", 
-                "No sensor was found with the name {}".format(sensor)
-            )
-        
-        if not request.json:
-            return create_error_response(415, "Unsupported media type",
-                "Requests must be JSON"
-            )
+    __slots__ = ("template", "values", "hrefs", "extra")
 
-        try:
-            validate(request.json, Sensor.get_schema())
-        except ValidationError as e:
-            return create_error_response(400, "Invalid JSON document", str(e))
-    
-        db_sensor.name = request.json["name"]
-        db_sensor.model = request.json["model"]
-        
-        try:
-            db.session.commit()
-        except IntegrityError:
-            return create_error_response(409, "Already exists", 
-                "Sensor with name '{}' already exists.".format(request.json["name"])
-            )
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+        self.hrefs = [None] * len(template.href_slots) if template.href_slots else ()
+        self.extra = None
 
-        return Response(status=204)
+    def add_namespace(self, ns, uri):
+        if self.extra is None:
+            self.extra = MasonBuilder()
+        self.extra.add_namespace(ns, uri)
 
-    def delete(self, sensor):
-        db_sensor = Sensor.query.filter_by(name=sensor).first()
-        if db_sensor is None:
-            return create_error_response(404, "Not found", 
-                "No sensor was found with the name {}".format(sensor)
-            )
+    def add_control(self, ctrl_name, href, **kwargs):
+        slot = self.template.href_slots.get(ctrl_name)
+        if slot is not None and kwargs == self.template.controls[ctrl_name][1]:
+            self.hrefs[slot] = href
+        else:
+            if self.extra is None:
+                self.extra = MasonBuilder()
+            self.extra.add_control(ctrl_name, href, **kwargs)
+
+    def expand(self):
+        obj = self.template.expand(self.values, self.hrefs)
+        if self.extra is not None:
+            for key, value in self.extra.items():
+                if key in obj and isinstance(value, dict):
+                    obj[key] = dict(obj[key], **value)
+                else:
+                    obj[key] = value
+        return obj
+
+    def to_json(self, encode):
+        if self.extra is not None or encode not in SPLICING_ENCODERS:
+            return encode(self.expand())
+        segments = self.template.segments(encode)
+        parts = [segments[0]]
+        for value, segment in zip(itertools.chain(self.values, self.hrefs), segments[1:]):
+            parts.append(encode(value))
+            parts.append(segment)
+        return b"".join(parts)
+
+
+SENSOR_ITEM = RecordTemplate("name", "model", "location")
+SENSOR_ITEM.add_control("self")
+SENSOR_ITEM.add_control("profile", SENSOR_PROFILE)
+
+MEASUREMENT_ITEM = RecordTemplate("value", "time")
+
+_url_templates = {}
+_control_templates = {}
+
+def cached_url_for(resource, **values):
+    """
+    Equivalent to api.url_for for resources whose URL variables are plain
+    strings. The URL is generated through the routing system only once per
+    resource, with placeholder values, and later calls substitute the quoted
+    values into that template.
 
-        db.session.delete(db_sensor)
-        db.session.commit()
+    : param resource: the Resource class to link to
+    """
 
-        return Response(status=204)
+    key = (resource, request.script_root, tuple(sorted(values)))
+    template = _url_templates.get(key)
+    if template is None:
+        to_url = current_app.url_map.converters["default"](current_app.url_map).to_url
+        url = api.url_for(resource, **{name: "\x00" + name for name in values})
+        template = _url_templates[key] = (url, [
+            (name, to_url("\x00" + name)) for name in values
+        ], to_url)
 
+    url, placeholders, to_url = template
+    for name, placeholder in placeholders:
+        url = url.replace(placeholder, to_url(values[name]))
+    return url
 
-class LocationItem(Resource):
 
-    def get(self, location):
-        return create_error_response(501, "Unimplemented")
+class ControlTemplate(object):
+    """
+    A Mason control that is built once per process. The control properties,
+    including the schema, are shared by every control created from the
+    template, and only the href is filled in per resource.
+    """
 
+    def __init__(self, ctrl_name, resource, query="", **kwargs):
+        """
+        : param str ctrl_name: name of the control (including namespace if any)
+        : param resource: the Resource class the control points to
+        : param str query: string appended to the URL, e.g. an href template
+        """
 
-class MeasurementCollection(Resource):
+        self.ctrl_name = ctrl_name
+        self.resource = resource
+        self.query = query
+        self.kwargs = kwargs
 
-    def get(self, sensor):
-        db_sensor = Sensor.query.filter_by(name=sensor).first()
-        if db_sensor is None:
-            return create_error_response(404, "Not found", 
-                "No sensor was found with the name {}".format(sensor)
-            )
+    def control(self, **values):
+        """
+        Returns the control object for the resource identified by the URL
+        variables in values.
+        """
 
-        try:
-            start = int(request.args.get("start", 0))
-        except ValueError:
-            return create_error_response(400, "Invalid query string value")
+        ctrl = self.kwargs.copy()
+        ctrl["href"] = cached_url_for(self.resource, **values) + self.query
+        return ctrl
+
+
+def control_template(key):
+    """
+    Returns a control template from the registry, which is built on first
+    use because it refers to the resource classes.
+
+    : param str key: registry key of the template
+    """
 
-        remaining = Measurement.query.filter_by(sensor=db_sensor).order_by("time").offset(start)
+    if not _control_templates:
+        _control_templates.update({
+            "delete-sensor": ControlTemplate(
+                "senhub:delete", SensorItem,
+                method="DELETE",
+                title="Delete this sensor"
+            ),
+            "add-measurement": ControlTemplate(
+                "senhub:add-measurement", MeasurementCollection,
+                method="POST",
+                encoding="json",
+                title="Add a new measurement for this sensor",
+                schema=Measurement.get_schema()
+            ),
+            "add-sensor": ControlTemplate(
+                "senhub:add-sensor", SensorCollection,
+                method="POST",
+                encoding="json",
+                title="Add a new sensor",
+                schema=Sensor.get_schema()
+            ),
+            "subscribe": ControlTemplate(
+                "senhub:subscribe", MeasurementSubscription,
+                title="Receive new measurements of this sensor as server-sent events",
+                accept=EVENT_STREAM
+            ),
+            "batch-sensors": ControlTemplate(
+                "senhub:batch", SensorBatch,
+                method="POST",
+                encoding="json",
+                title="Create, modify and delete sensors in one transaction",
+                schema=SensorhubBuilder._batch_schema()
+            ),
+            "modify-sensor": ControlTemplate(
+                "edit", SensorItem,
+                method="PUT",
+                encoding="json",
+                title="Edit this sensor",
+                schema=Sensor.get_schema()
+            ),
+            "get-measurements": ControlTemplate(
+                "senhub:measurements", MeasurementCollection,
+                query="?start={index}&from={from}&to={to}",
+                isHrefTemplate=True,
+                schema=SensorhubBuilder._paginator_schema()
+            ),
+            "aggregate-measurements": ControlTemplate(
+                "senhub:aggregate", MeasurementAggregate,
+                query="?start={start}&end={end}&bucket={bucket}&method={method}",
+                isHrefTemplate=True,
+                title="Aggregate measurements over time buckets",
+                schema=SensorhubBuilder._aggregate_schema()
+            ),
+        })
+    return _control_templates[key]
+
+def sensor_collection_statement():
+    # Only the columns the representation needs, with the location name
+    # joined in, so listing N sensors is one statement instead of N + 1.
+    return select(Sensor.name, Sensor.model, Location.name).outerjoin(Sensor.location)
+
+def sensor_collection_body():
+    body = SensorhubBuilder()
+    body.add_namespace("senhub", LINK_RELATIONS_URL)
+    body.add_control("self", cached_url_for(SensorCollection))
+    body.add_control_add_sensor()
+    body.add_control_batch_sensors()
+    return body
+
+def sensor_items(rows):
+    """
+    Yields the collection items of (name, model, location name) rows of a
+    sensor_collection_statement.
+    """
+
+    for name, model, location in rows:
+        item = SENSOR_ITEM.record(name, model, location)
+        item.add_control("self", cached_url_for(SensorItem, sensor=name))
+        yield item
+
+def sensor_item_statement(sensor):
+    return sensor_collection_statement().where(Sensor.name == sensor)
+
+def sensor_item_body(name, model, location):
+    """
+    Builds the representation of a sensor from a row of a
+    sensor_item_statement.
+    """
 
-        body = SensorhubBuilder(
-            items=[]
+    body = SensorhubBuilder(
+        name=name,
+        model=model,
+        location=location
+    )
+    body.add_namespace("senhub", LINK_RELATIONS_URL)
+    body.add_control("self", cached_url_for(SensorItem, sensor=name))
+    body.add_control("profile", SENSOR_PROFILE)
+    body.add_control("collection", cached_url_for(SensorCollection))
+    body.add_control_delete_sensor(name)
+    body.add_control_modify_sensor(name)
+    body.add_control_add_measurement(name)
+    body.add_control_get_measurements(name)
+    body.add_control("senhub:measurements-first",
+        cached_url_for(MeasurementCollection, sensor=name)
+    )
+    body.add_control_aggregate_measurements(name)
+    body.add_control_subscribe(name)
+    if location is not None:
+        body.add_control("senhub:location",
+            api.url_for(LocationItem, location=location)
         )
-        body.add_namespace("senhub", LINK_RELATIONS_URL)
-        base_uri = api.url_for(MeasurementCollection, sensor=sensor)
-        body.add_control("up", api.url_for(SensorItem, sensor=sensor))
-        if start >= 50:
-            body.add_control("self", base_uri + "?start={}".format(start))
-            body.add_control("prev", base_uri + "?start={}".format(start - MEASUREMENT_PAGE_SIZE))
-        else:
-            body.add_control("self", base_uri)
-        if remaining.count() > 50:
-            body.add_control("next", base_uri + "?start={}".format(start + MEASUREMENT_PAGE_SIZE))
-
-        for meas in remaining.limit(MEASUREMENT_PAGE_SIZE):
-            item = SensorhubBuilder(
-                value=meas.value,
-                time=meas.time.isoformat()
-            )
-            body["items"].append(item)
+    return body
+
+def measurement_page_body(sensor, page, has_prev, has_next, args):
+    """
+    Builds the representation of a measurement page, without its items, from
+    the result of measurement_page and the parsed request arguments.
+    """
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+    body = SensorhubBuilder()
+    body.add_namespace("senhub", LINK_RELATIONS_URL)
+    base_uri = cached_url_for(MeasurementCollection, sensor=sensor)
+
+    def page_uri(**params):
+        params.update(args["window"])
+        return base_uri + "?" + urlencode(params) if params else base_uri
+
+    body.add_control("up", cached_url_for(SensorItem, sensor=sensor))
+    if args["cursor"]:
+        body.add_control("self", page_uri(cursor=args["cursor"]))
+    elif args["start"] > 0:
+        body.add_control("self", page_uri(start=args["start"]))
+    else:
+        body.add_control("self", page_uri())
+    if page and has_prev:
+        body.add_control("prev", page_uri(cursor=encode_cursor("b", page[0])))
+    if page and has_next:
+        body.add_control("next", page_uri(cursor=encode_cursor("a", page[-1])))
+    return body
+
+def measurement_items(page):
+    return (MEASUREMENT_ITEM.record(meas.value, meas.time) for meas in page)
+
+def encode_cursor(direction, meas):
+    """
+    Encodes a keyset pagination cursor. The cursor points just past (direction
+    "a", after) or just before (direction "b", before) the given measurement in
+    (time, id) order. Clients are expected to treat the result as an opaque
+    string.
 
-# ^
-# |
-# RESOURCES
-# ROUTES & CLI
-# |
-# v
+    : param str direction: either "a" or "b"
+    : param Measurement meas: the measurement the cursor is anchored to
+    """
 
-app.register_blueprint(api_bp)
+    raw = "{}|{}|{}".format(direction, meas.time.isoformat(), meas.id)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
 
-api.add_resource(SensorCollection, "/sensors/")
-api.add_resource(SensorItem, "/sensors/<sensor>/")
-api.add_resource(LocationItem, "/locations/<location>/")
-api.add_resource(MeasurementCollection, "/sensors/<sensor>/measurements/")
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor. Returns a (direction, time, id)
+    tuple, or raises ValueError if the cursor is malformed.
 
-@app.route(LINK_RELATIONS_URL)
-def send_link_relations():
-    return "link relations"
+    : param str cursor: cursor from the query string
+    """
 
-@app.route("/profiles/<profile>/")
-def send_profile(profile):
-    return "you requests {} profile".format(profile)
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        direction, time, id_ = raw.split("|")
+    except (UnicodeError, ValueError, TypeError) as e:
+        raise ValueError("Malformed cursor") from e
+    if direction not in ("a", "b"):
+        raise ValueError("Malformed cursor")
+    return direction, datetime.datetime.fromisoformat(time), int(id_)
+
+def after_position(time, id_):
+    """
+    Returns filter criteria for measurements that come after (time, id_) in
+    page order. The redundant time >= condition lets the database seek on the
+    (sensor_id, time, id) index instead of evaluating the OR row by row.
+    """
 
-@app.route("/admin/")
-def admin_site():
-    return app.send_static_file("html/admin.html")
+    return (
+        Measurement.time >= time,
+        or_(Measurement.time > time, Measurement.id > id_)
+    )
 
-@click.command("init-db")
-@with_appcontext
-def init_db_command():
-    db.create_all()
+def before_position(time, id_):
+    """
+    Returns filter criteria for measurements that come before (time, id_) in
+    page order. See after_position.
+    """
 
-@click.command("testgen")
-@with_appcontext
-def generate_test_data():
-    import datetime
-    import random
-    s = Sensor(
-        name="test-sensor-1",
-        model="testsensor"
+    return (
+        Measurement.time <= time,
+        or_(Measurement.time < time, Measurement.id < id_)
     )
-    now = datetime.datetime.now()
-    interval = datetime.timedelta(seconds=10)
-    for i in range(1000):
-        m = Measurement(
-            value=round(random.random() * 100, 2),
-            time=now
-        )
-        now += interval
-        s.measurements.append(m)
-    
-    db.session.add(s)
-    db.session.commit()
 
-app.cli.add_command(init_db_command)
-app.cli.add_command(generate_test_data)
+def measurement_page_statement(criteria, start=0, cursor=None):
+    """
+    Builds the statement for one page of measurements in (time, id) order.
+    It asks for one row more than the page size; the extra row only tells
+    whether there is anything beyond the page, so no separate COUNT query is
+    needed. See measurement_page for turning the rows into the page.
+
+    : param list criteria: filter criteria, including the sensor
+    : param int start: offset for the legacy ?start= form
+    : param tuple cursor: decoded (direction, time, id) cursor, if any
+    """
+
+    statement = select(Measurement.id, Measurement.time, Measurement.value).where(*criteria)
+    if cursor is None:
+        return statement.order_by(
+            Measurement.time, Measurement.id
+        ).offset(start).limit(MEASUREMENT_PAGE_SIZE + 1)
+
+    direction, cur_time, cur_id = cursor
+    if direction == "a":
+        return statement.where(*after_position(cur_time, cur_id)).order_by(
+            Measurement.time, Measurement.id
+        ).limit(MEASUREMENT_PAGE_SIZE + 1)
+
+    return statement.where(*before_position(cur_time, cur_id)).order_by(
+        Measurement.time.desc(), Measurement.id.desc()
+    ).limit(MEASUREMENT_PAGE_SIZE + 1)
+
+def measurement_page(rows, start=0, cursor=None):
+    """
+    Turns the rows of a measurement_page_statement into a (page, has_prev,
+    has_next) tuple, the page in (time, id) order.
+    """
+
+    if cursor is None:
+        return rows[:MEASUREMENT_PAGE_SIZE], start > 0, len(rows) > MEASUREMENT_PAGE_SIZE
+    if cursor[0] == "a":
+        return rows[:MEASUREMENT_PAGE_SIZE], True, len(rows) > MEASUREMENT_PAGE_SIZE
+    return rows[:MEASUREMENT_PAGE_SIZE][::-1], len(rows) > MEASUREMENT_PAGE_SIZE, True
+
+def measurement_page_pin(page, has_next, args):
+    """
+    Returns the time before which a measurement must be stored to change a
+    page, or None if any stored measurement can change it. A full page that
+    is followed by more measurements only depends on the measurements up to
+    its last item (or up to the cursor for pages before a cursor), and new
+    measurements get the highest ids, so those stored at or after that time
+    sort behind the page.
+    """
+
+    if len(page) < MEASUREMENT_PAGE_SIZE or not has_next or args["with_total"]:
+        return None
+    if args["position"] is not None and args["position"][0] == "b":
+        return args["position"][1]
+    return page[-1].time
+
+def late_measurement_statement(criteria, pinned, mark):
+    """
+    Builds a statement that finds a measurement which changes a page pinned
+    at the given time and was stored after the page was read, when mark was
+    the highest measurement id. Such measurements get higher ids, so the
+    query only looks at rows stored since.
+    """
+
+    return select(Measurement.id).where(
+        *criteria, Measurement.id > (mark or 0), Measurement.time < pinned
+    ).limit(1)
+
+def measurement_mark_statement():
+    return select(func.max(Measurement.id))
+
+def paginate_measurements(criteria, start=0, cursor=None):
+    """
+    Fetches one page of measurements matching criteria with a single query.
+    Returns a (page, has_prev, has_next) tuple.
+    """
+
+    rows = db.session.execute(measurement_page_statement(criteria, start, cursor)).all()
+    return measurement_page(rows, start, cursor)
+
+def measurement_page_args():
+    """
+    Parses the paging and window parameters of a measurement collection
+    request into a dictionary. Raises ValueError for malformed values.
+    """
+
+    cursor = request.args.get("cursor")
+    window = {
+        key: request.args[key] for key in ("from", "to") if request.args.get(key)
+    }
+    args = {
+        "cursor": cursor,
+        "window": window,
+        "start": int(request.args.get("start") or 0),
+        "position": decode_cursor(cursor) if cursor else None,
+        "with_total": request.args.get("withTotal") in ("1", "true"),
+    }
+    for key in ("from", "to"):
+        args[key] = (
+            datetime.datetime.strptime(window[key], TIMESTAMP_FORMAT)
+            if key in window else None
+        )
+    return args
+
+def measurement_criteria(sensor_id, args):
+    """
+    Returns the filter criteria for the measurements of a sensor within the
+    time window of the parsed request arguments.
+    """
+
+    criteria = [Measurement.sensor_id == sensor_id]
+    if args["from"] is not None:
+        criteria.append(Measurement.time >= args["from"])
+    if args["to"] is not None:
+        criteria.append(Measurement.time < args["to"])
+    return criteria
+
+def count_statement(criteria):
+    return select(func.count()).select_from(Measurement).where(*criteria)
+
+def hot_queries():
+    """
+    Returns (name, statement) pairs for the queries that run on every request
+    to the API. These are the queries check-query-plans verifies against the
+    database's query planner.
+    """
+
+    any_time = datetime.datetime(2000, 1, 1)
+    by_sensor = select(Measurement).where(Measurement.sensor_id == 1)
+    page_size = MEASUREMENT_PAGE_SIZE + 1
+    return [
+        ("sensor by name", select(Sensor).where(Sensor.name == "name")),
+        ("measurements first page", by_sensor.order_by(
+            Measurement.time, Measurement.id
+        ).limit(page_size)),
+        ("measurements after cursor", by_sensor.where(
+            *after_position(any_time, 1)
+        ).order_by(Measurement.time, Measurement.id).limit(page_size)),
+        ("measurements before cursor", by_sensor.where(
+            *before_position(any_time, 1)
+        ).order_by(Measurement.time.desc(), Measurement.id.desc()).limit(page_size)),
+        ("measurements in window", by_sensor.where(
+            Measurement.time >= any_time, Measurement.time < any_time
+        ).order_by(Measurement.time, Measurement.id).limit(page_size)),
+        ("sensor deployments", select(deployments).where(deployments.c.sensor_id == 1)),
+    ]
+
+def parse_measurement(doc, sensor_id):
+    """
+    Turns a validated measurement document into a row for the measurement
+    table. Readings without a timestamp are stamped with the current UTC time.
+    """
+
+    if "time" in doc:
+        time = datetime.datetime.strptime(doc["time"], TIMESTAMP_FORMAT)
+    else:
+        time = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return {
+        "sensor_id": sensor_id,
+        "value": doc["value"],
+        "time": time,
+    }
+
+def parse_bucket(value):
+    """
+    Parses a bucket size such as "30s", "5m", "1h" or "1d" into seconds.
+    Raises ValueError for anything else.
+    """
+
+    if len(value) < 2 or value[-1] not in BUCKET_UNITS:
+        raise ValueError("Invalid bucket size")
+    count = int(value[:-1])
+    if count < 1:
+        raise ValueError("Invalid bucket size")
+    return count * BUCKET_UNITS[value[-1]]
+
+def format_epoch(seconds):
+    return datetime.datetime.fromtimestamp(
+        int(seconds), datetime.timezone.utc
+    ).strftime(TIMESTAMP_FORMAT)
+
+def epoch_seconds(column):
+    """
+    Returns a SQL expression for a DateTime column as integer seconds since
+    the Unix epoch, for the dialect of the current engine.
+    """
+
+    if db.engine.dialect.name == "sqlite":
+        return cast(func.strftime("%s", column), Integer)
+    return cast(func.extract("epoch", column), Integer)
+
+def to_epoch(time):
+    return (time - EPOCH) // datetime.timedelta(seconds=1)
+
+def pick_rollup(start, end, size):
+    """
+    Returns the coarsest rollup table whose buckets nest exactly inside the
+    requested buckets and window, or None if only raw measurements will do.
+    """
+
+    for rollup in ROLLUPS:
+        resolution = rollup.resolution
+        if size % resolution == 0 and to_epoch(start) % resolution == 0 and to_epoch(end) % resolution == 0:
+            return rollup
+    return None
+
+def aggregate_measurements(sensor_id, start, end, size):
+    """
+    Computes min, max, avg and count of a sensor's measurements per time
+    bucket with a single GROUP BY query. Buckets are aligned to multiples of
+    size seconds since the epoch, and empty buckets are left out. The query
+    reads the coarsest rollup table that can answer it, and falls back to
+    the measurement table. Returns a list of dictionaries in time order.
+    """
+
+    rollup = pick_rollup(start, end, size)
+    if rollup is None:
+        epoch = epoch_seconds(Measurement.time)
+        bucket = (epoch - epoch % size).label("bucket")
+        query = select(
+            bucket,
+            func.min(Measurement.value),
+            func.max(Measurement.value),
+            func.avg(Measurement.value),
+            func.count(Measurement.id)
+        ).where(
+            Measurement.sensor_id == sensor_id,
+            Measurement.time >= start,
+            Measurement.time < end
+        )
+    else:
+        bucket = (rollup.bucket - rollup.bucket % size).label("bucket")
+        query = select(
+            bucket,
+            func.min(rollup.min),
+            func.max(rollup.max),
+            func.sum(rollup.sum) / func.sum(rollup.count),
+            func.sum(rollup.count)
+        ).where(
+            rollup.sensor_id == sensor_id,
+            rollup.bucket >= to_epoch(start),
+            rollup.bucket < to_epoch(end)
+        )
+    rows = db.session.execute(query.group_by(bucket).order_by(bucket))
+    return [
+        {
+            "start": format_epoch(bucket_start),
+            "min": min_,
+            "max": max_,
+            "avg": avg,
+            "count": count,
+        }
+        for bucket_start, min_, max_, avg, count in rows
+    ]
+
+def aggregate_measurements_numpy(sensor_id, start, end, size, method):
+    """
+    Computes a per-bucket quantile of a sensor's measurements with NumPy,
+    for downsampling methods that plain SQL aggregates cannot express. The
+    (time, value) columns are read straight from the cursor into arrays and
+    every bucket is computed in one vectorized pass. The nearest-rank
+    quantile is used, except for the median which averages the two middle
+    values of even-sized buckets.
+    """
+
+    result = db.session.execute(
+        select(epoch_seconds(Measurement.time), Measurement.value)
+        .where(
+            Measurement.sensor_id == sensor_id,
+            Measurement.time >= start,
+            Measurement.time < end
+        )
+    )
+    data = np.fromiter(
+        (tuple(row) for row in result),
+        dtype=[("time", np.int64), ("value", np.float64)]
+    )
+    if not len(data):
+        return []
+
+    buckets = data["time"] - data["time"] % size
+    order = np.lexsort((data["value"], buckets))
+    buckets = buckets[order]
+    values = data["value"][order]
+    starts, first, counts = np.unique(buckets, return_index=True, return_counts=True)
+    quantile = AGGREGATE_METHODS[method]
+    low = first + np.floor((counts - 1) * quantile).astype(np.int64)
+    if method == "median":
+        high = first + np.ceil((counts - 1) * quantile).astype(np.int64)
+        results = (values[low] + values[high]) / 2
+    else:
+        results = values[low]
+    return [
+        {"start": format_epoch(bucket_start), method: float(value), "count": int(count)}
+        for bucket_start, value, count in zip(starts, results, counts)
+    ]
+
+# dialect specific INSERTs that support ON CONFLICT DO UPDATE
+UPSERT_INSERTS = {
+    "postgresql": postgresql_insert,
+    "sqlite": sqlite_insert,
+}
+
+def rollup_upsert(table):
+    """
+    Builds an INSERT into a rollup table that merges into the bucket row if
+    it already exists. The merge is done by the database relative to the
+    stored row, so concurrent writers add up instead of overwriting each
+    other.
+    """
+
+    statement = UPSERT_INSERTS[db.engine.dialect.name](table)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.sensor_id, table.c.bucket],
+        set_={
+            "min": case((excluded.min < table.c.min, excluded.min), else_=table.c.min),
+            "max": case((excluded.max > table.c.max, excluded.max), else_=table.c.max),
+            "sum": table.c.sum + excluded.sum,
+            "count": table.c.count + excluded.count,
+        }
+    )
+
+def update_rollups(rows, tables=None):
+    """
+    Folds measurement rows (dictionaries with sensor_id, value and time) into
+    every rollup table in the current transaction. The rows are summarized
+    per bucket in Python first, so each rollup table gets one executemany
+    upsert (see rollup_upsert).
+
+    : param list rows: measurement rows
+    : param dict tables: table to fold into for each rollup model, by
+        default the model's own table
+    """
+
+    for rollup in ROLLUPS:
+        resolution = rollup.resolution
+        summary = {}
+        for row in rows:
+            key = (row["sensor_id"], to_epoch(row["time"]) // resolution * resolution)
+            value = row["value"]
+            current = summary.get(key)
+            if current is None:
+                summary[key] = [value, value, value, 1]
+            else:
+                current[0] = min(current[0], value)
+                current[1] = max(current[1], value)
+                current[2] += value
+                current[3] += 1
+        if not summary:
+            continue
+
+        table = rollup.__table__ if tables is None else tables[rollup]
+        # in key order, so that concurrent writers lock rows in the same order
+        db.session.connection().execute(rollup_upsert(table), [
+            {
+                "sensor_id": key[0], "bucket": key[1],
+                "min": agg[0], "max": agg[1], "sum": agg[2], "count": agg[3],
+            }
+            for key, agg in sorted(summary.items())
+        ])
+
+def rollup_scratch_table(rollup):
+    """
+    Returns a table with the columns of a rollup model's table, but without
+    its foreign key, for rebuild-rollups to build the rollups in.
+    """
+
+    return Table(rollup.__tablename__ + "_rebuild", MetaData(), *(
+        Column(column.name, column.type, primary_key=column.primary_key,
+            nullable=column.nullable
+        )
+        for column in rollup.__table__.columns
+    ))
+
+def delete_rollups(sensor_id):
+    for rollup in ROLLUPS:
+        db.session.execute(delete(rollup.__table__).where(rollup.sensor_id == sensor_id))
+
+def plan_sensor_batch(operations, existing):
+    """
+    Replays a list of batch operations, in order, against the names of the
+    sensors they refer to, and reduces them to their net effect: the ids of
+    existing sensors to delete, the new name and model of existing sensors
+    to update, and the sensors to create. Operations that are not possible
+    at their point in the batch are reported as (index, message) errors.
+
+    : param list operations: operation documents valid against SensorBatch's schema
+    : param dict existing: ids of the existing sensors, by name
+    """
+
+    # name -> id of an existing sensor, or the key of a sensor to create
+    state = dict(existing)
+    deletes = set()
+    updates = {}
+    creates = {}
+    errors = []
+    for index, op in enumerate(operations):
+        if op["op"] != "create" and op["sensor"] not in state:
+            errors.append((index, "No sensor was found with the name {}".format(op["sensor"])))
+            continue
+        if op["op"] != "delete" and op["name"] in state and op["name"] != op.get("sensor"):
+            errors.append((index, "Sensor with name '{}' already exists.".format(op["name"])))
+            continue
+
+        if op["op"] == "create":
+            key = state[op["name"]] = ("new", index)
+            creates[key] = {"name": op["name"], "model": op["model"]}
+        elif op["op"] == "update":
+            key = state.pop(op["sensor"])
+            state[op["name"]] = key
+            target = creates if key in creates else updates
+            target[key] = {"name": op["name"], "model": op["model"]}
+        else:
+            key = state.pop(op["sensor"])
+            if key in creates:
+                del creates[key]
+            else:
+                updates.pop(key, None)
+                deletes.add(key)
+    return errors, deletes, updates, list(creates.values())
+
+def apply_sensor_batch(deletes, updates, creates, original):
+    """
+    Applies the net effect of a sensor batch with a handful of bulk statements
+    in the current transaction: deletes first, then updates, then creates, so
+    that names freed by the earlier ones can be reused by the later ones.
+    Renames that take each other's names go through a temporary name first.
+    Committing is left to the caller.
+
+    : param set deletes: ids of the sensors to delete
+    : param dict updates: new name and model of the sensors to update, by id
+    : param list creates: name and model of the sensors to create
+    : param dict original: current names of the updated sensors, by id
+    """
+
+    sensors = Sensor.__table__
+    if deletes:
+        for rollup in ROLLUPS:
+            db.session.execute(delete(rollup.__table__).where(rollup.sensor_id.in_(deletes)))
+        db.session.execute(
+            update(Measurement.__table__)
+            .where(Measurement.sensor_id.in_(deletes))
+            .values(sensor_id=None)
+        )
+        db.session.execute(delete(deployments).where(deployments.c.sensor_id.in_(deletes)))
+        db.session.execute(delete(sensors).where(sensors.c.id.in_(deletes)))
+
+    if updates:
+        statement = update(sensors).where(sensors.c.id == bindparam("b_id"))
+        rows = [
+            {"b_id": key, "name": values["name"], "model": values["model"]}
+            for key, values in updates.items()
+        ]
+        renamed = {key for key, values in updates.items() if values["name"] != original[key]}
+        if {updates[key]["name"] for key in renamed} & {original[key] for key in renamed}:
+            db.session.execute(
+                statement.values(name="#" + cast(bindparam("b_id"), db.String)),
+                [{"b_id": key} for key in renamed]
+            )
+        db.session.execute(statement, rows)
+
+    if creates:
+        db.session.execute(insert(sensors), creates)
+
+def export_media_types():
+    """
+    Returns the media types MeasurementCollection can be served as, with the
+    binary ones depending on which optional libraries are installed.
+    """
+
+    types = [MASON]
+    if np is not None:
+        types.append(NPY)
+        if pa is not None:
+            types.append(ARROW_STREAM)
+    return types
+
+def iter_measurement_columns(criteria):
+    """
+    Reads (epoch seconds, value) pairs of the measurements matching criteria
+    in time order from a server-side cursor, and yields them as pairs of
+    int64 and float64 NumPy arrays of at most EXPORT_BATCH_SIZE elements.
+    The select runs on the session's connection to skip ORM row loading.
+    """
+
+    result = db.session.connection().execute(
+        select(epoch_seconds(Measurement.time), Measurement.value)
+        .where(*criteria)
+        .order_by(Measurement.time, Measurement.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    for batch in result.partitions():
+        columns = np.fromiter(
+            itertools.chain.from_iterable(batch), np.float64, count=2 * len(batch)
+        ).reshape(-1, 2)
+        yield columns[:, 0].astype(np.int64), columns[:, 1]
+
+def iter_npy(count, batches):
+    """
+    Streams measurement column batches as a single .npy file holding a
+    structured array with a datetime64[s] time field and a float64 value
+    field. The header needs the row count up front; should the rows change
+    between counting and reading, the array is cut or padded with NaT/NaN
+    so that the file stays valid.
+    """
+
+    dtype = np.dtype([("time", "<M8[s]"), ("value", "<f8")])
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        "descr": np.lib.format.dtype_to_descr(dtype),
+        "fortran_order": False,
+        "shape": (count,),
+    })
+    yield header.getvalue()
+
+    remaining = count
+    for times, values in batches:
+        size = min(len(times), remaining)
+        chunk = np.empty(size, dtype)
+        chunk["time"] = times[:size]
+        chunk["value"] = values[:size]
+        remaining -= size
+        yield chunk.tobytes()
+    if remaining:
+        chunk = np.empty(remaining, dtype)
+        chunk["time"] = np.datetime64("NaT")
+        chunk["value"] = np.nan
+        yield chunk.tobytes()
+
+def iter_arrow(batches):
+    """
+    Streams measurement column batches in the Arrow IPC stream format, one
+    record batch per column batch, with a UTC timestamp[s] time column and a
+    float64 value column.
+    """
+
+    time_type = pa.timestamp("s", tz="UTC")
+    schema = pa.schema([("time", time_type), ("value", pa.float64())])
+    sink = io.BytesIO()
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    writer = pa.ipc.new_stream(sink, schema)
+    yield drain()
+    for times, values in batches:
+        writer.write_batch(pa.record_batch(
+            [pa.array(times, type=time_type), pa.array(values)], schema=schema
+        ))
+        yield drain()
+    writer.close()
+    yield drain()
+
+def insert_measurements(rows):
+    """
+    Inserts measurement rows (dictionaries with sensor_id, value and time) as
+    a single executemany-style INSERT in the current transaction, and folds
+    them into the rollup tables. Committing is left to the caller.
+    """
+
+    if rows:
+        db.session.execute(Measurement.__table__.insert(), rows)
+        update_rollups(rows)
+
+def bulk_insert(table, columns):
+    """
+    Inserts rows given as a dictionary of equally long column lists with one
+    executemany on the session's connection. The INSERT is compiled by Core
+    for the current dialect, but the parameters skip SQLAlchemy's per row
+    processing, so values must already be in a form the driver accepts (see
+    bulk_time_values). Committing is left to the caller.
+    """
+
+    names = list(columns)
+    compiled = insert(table).compile(dialect=db.engine.dialect, column_keys=names)
+    if compiled.positional:
+        rows = list(zip(*(columns[name] for name in compiled.positiontup)))
+    else:
+        rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+    connection = db.session.connection()
+    connection.exec_driver_sql(str(compiled), rows)
+    bump_table_versions(connection, version_names(table, columns.get("sensor_id")))
+
+def bulk_time_values(times):
+    """
+    Converts a datetime64 array into driver values for a DateTime column.
+    SQLite gets the text SQLAlchemy itself stores there, built in one
+    vectorized step, other backends get datetime objects.
+    """
+
+    times = times.astype("datetime64[us]")
+    if db.engine.dialect.name == "sqlite":
+        return np.char.replace(np.datetime_as_string(times, unit="us"), "T", " ").tolist()
+    return times.tolist()
+
+def summarize_buckets(seconds, values, resolution):
+    """
+    Summarizes time ordered readings into bucket, min, max, sum and count
+    arrays, one element per bucket of the given resolution in seconds.
+    """
+
+    buckets = seconds // resolution * resolution
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    return (
+        buckets[starts],
+        np.minimum.reduceat(values, starts),
+        np.maximum.reduceat(values, starts),
+        np.add.reduceat(values, starts),
+        np.diff(np.r_[starts, len(values)]),
+    )
+
+def insert_rollup_buckets(rollup, sensor_id, summary):
+    """
+    Bulk inserts new rollup rows for one sensor from summarize_buckets style
+    arrays. Only for buckets that have no row yet, see update_rollups for
+    merging into existing ones.
+    """
+
+    buckets, minimums, maximums, sums, counts = summary
+    if len(buckets):
+        bulk_insert(rollup.__table__, {
+            "sensor_id": [sensor_id] * len(buckets),
+            "bucket": np.asarray(buckets).tolist(),
+            "min": np.asarray(minimums).tolist(),
+            "max": np.asarray(maximums).tolist(),
+            "sum": np.asarray(sums).tolist(),
+            "count": np.asarray(counts).tolist(),
+        })
+
+def generate_values(rng, distribution, seconds, state):
+    """
+    Generates readings for the given epoch seconds. The walk distribution
+    continues from the level kept in state so that a series generated in
+    chunks has no jumps at chunk boundaries.
+    """
+
+    n = len(seconds)
+    if distribution == "uniform":
+        values = rng.uniform(0, 100, n)
+    elif distribution == "normal":
+        values = rng.normal(50, 15, n)
+    elif distribution == "walk":
+        values = state.get("level", 50.0) + np.cumsum(rng.normal(0, 1, n))
+        state["level"] = values[-1]
+    else:
+        phase = 2 * np.pi * (seconds % 86400) / 86400
+        values = 50 - 25 * np.cos(phase) + rng.normal(0, 2, n)
+    return np.round(values, 2)
+
+def read_ndjson(stream):
+    """
+    Reads newline delimited JSON documents from a stream one line at a time.
+    Yields (line number, document, error) tuples where line numbers count
+    from 1 and error is None unless the line could not be parsed. Blank lines
+    are skipped but counted.
+    """
+
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, "Invalid JSON: {}".format(e)
+
+def table_validators(*tables, variant=""):
+    """
+    Builds HTTP validators for a representation that depends only on the
+    given tables. Returns an (etag, last_modified) tuple computed from the
+    tables' write counters and the request URL, which costs one small query
+    and no ORM work. Resources with several representations pass the chosen
+    media type as variant so that each gets its own ETag.
+    """
+
+    rows = db.session.execute(versions_statement(tables)).all()
+    g.response_validated = (tables, variant, table_versions(rows))
+    return versions_validators(rows, variant)
+
+def versions_statement(tables):
+    versions = TableVersion.__table__
+    return (
+        select(versions.c.table, versions.c.version, versions.c.modified)
+        .where(versions.c.table.in_(tables))
+        .order_by(versions.c.table)
+    )
+
+def table_versions(rows):
+    """
+    Maps the tables in the rows of a versions_statement to their
+    (version, modified) pairs.
+    """
+
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+def versions_validators(rows, variant=""):
+    """
+    Computes the (etag, last_modified) validators of table_validators from
+    the rows of a versions_statement.
+    """
+
+    digest = hashlib.sha1((request.full_path + variant).encode("utf-8"))
+    for row in rows:
+        digest.update("|{}:{}:{}".format(*row).encode("utf-8"))
+    last_modified = max((row.modified for row in rows), default=None)
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    return digest.hexdigest()[:32], last_modified
+
+def not_modified_response(validators):
+    """
+    Returns a 304 response if the request's If-None-Match or, in its absence,
+    If-Modified-Since header matches the validators. Returns None otherwise.
+    """
+
+    etag, last_modified = validators
+    if request.if_none_match:
+        if not request.if_none_match.contains(etag):
+            return None
+    elif request.if_modified_since is None or last_modified is None:
+        return None
+    elif last_modified > request.if_modified_since:
+        return None
+
+    response = Response(status=304)
+    return add_validators(response, validators)
+
+def add_validators(response, validators):
+    """
+    Sets the ETag and Last-Modified headers of a response.
+    """
+
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+class ResponseCache(object):
+    """
+    A bounded in-process LRU cache for successful GET responses of the API.
+    Entries are keyed on method, path and query string, and the total size of
+    cached bodies is capped in bytes. Resources opt in by calling cache_as()
+    with the tags that describe what the representation depends on, and
+    write handlers invalidate by tag after they commit. Pinned entries only
+    depend on measurements from before their pin time, and survive the
+    invalidations of writes that stored nothing earlier than that. Before an
+    entry is served, it is checked against the table write counters its
+    validators came from, which catches writes this cache was not told
+    about, see revalidate_cached_response.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.tagged = defaultdict(set)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def request_key():
+        return (
+            request.method, request.path, request.query_string,
+            request.headers.get("Accept", "")
+        )
+
+    def get(self, key, revalidate=None):
+        """
+        Returns the entry stored under key, or None. If revalidate is given,
+        it is called with the entry outside the lock and returns the entry,
+        a replacement for it or None if it is stale, which drops it.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and revalidate is not None:
+            current = revalidate(entry)
+            if current is not entry:
+                self.replace(key, entry, current)
+            entry = current
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def peek(self, key):
+        """
+        Returns the entry stored under key, or None, without counting a hit
+        or a miss.
+        """
+
+        with self.lock:
+            return self.entries.get(key)
+
+    def replace(self, key, entry, current):
+        """
+        Replaces an entry with a revalidated one, or drops it if current is
+        None. Nothing happens if the entry was replaced in the meantime.
+        """
+
+        with self.lock:
+            if self.entries.get(key) is not entry:
+                return
+            if current is None:
+                self.remove(key)
+                self.stale += 1
+            else:
+                self.entries[key] = current
+
+    def remove(self, key):
+        """
+        Drops the entry stored under key from the entries and the tag index.
+        Must be called with the lock held.
+        """
+
+        entry = self.entries.pop(key)
+        self.size -= len(entry["body"])
+        for tag in entry["tags"]:
+            keys = self.tagged[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tagged[tag]
+
+    def put(self, key, entry):
+        size = len(entry["body"])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.size += size
+            for tag in entry["tags"]:
+                self.tagged[tag].add(key)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags, since=None):
+        """
+        Drops every entry tagged with any of the given tags. If the write
+        only stored measurements, since is the earliest of their times, and
+        entries pinned at or before it are kept. Only the entries under the
+        tags are looked at, so a write does not walk the whole cache.
+        """
+
+        with self.lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self.tagged.get(tag, ()))
+            for key in keys:
+                pinned = self.entries[key]["pinned"]
+                if pinned is None or since is None or since < pinned:
+                    self.remove(key)
+
+    def store(self, key, response, tags, pinned, validated=None, late=None):
+        """
+        Stores a response once its body is complete. Streamed bodies are
+        collected while they are sent to the client, and are not stored if
+        they outgrow the cache. validated holds the (tables, variant, rows)
+        the response's validators were computed from, and late the
+        statement of cache_as, see revalidation_state.
+        """
+
+        status = response.status_code
+        headers = [(k, v) for k, v in response.headers if k != "Content-Length"]
+
+        # entry and collect must not refer to the response, which holds the
+        # collecting generator: the cycle would leave a dropped response to
+        # the garbage collector, which closes it later in some other context
+        def entry(body):
+            return {
+                "status": status,
+                "headers": headers,
+                "body": body,
+                "tags": tags,
+                "pinned": pinned,
+                "validated": validated,
+                "late": late,
+            }
+
+        if not response.is_streamed:
+            self.put(key, entry(response.get_data()))
+            return response
+
+        chunks = response.response
+        def collect():
+            parts = []
+            size = 0
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode("utf-8")
+                    if parts is not None:
+                        size += len(chunk)
+                        parts.append(chunk)
+                        if size > self.max_bytes:
+                            parts = None
+                    yield chunk
+            finally:
+                # a body closed before it is exhausted must still close the
+                # inner generator, which pops the request context that
+                # stream_with_context pushed for it
+                if hasattr(chunks, "close"):
+                    chunks.close()
+            if parts is not None:
+                self.put(key, entry(b"".join(parts)))
+
+        response.response = collect()
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "stale": self.stale,
+            }
+
+def cache_as(*tags, pinned=None, late=None):
+    """
+    Marks the response of the current request as cacheable under the given
+    invalidation tags. A pinned response only changes when a measurement
+    earlier than the pin time is stored, see measurement_page_pin, and late
+    is a statement that finds such a measurement stored after the response
+    was read, see late_measurement_statement.
+    """
+
+    g.response_cache_tags = set(tags)
+    g.response_cache_pinned = pinned
+    g.response_cache_late = late
+
+def revalidation_state(entry, rows):
+    """
+    Compares the table versions a cached response was validated against
+    with the current rows of its versions_statement. Returns "current" if
+    none of them changed and "stale" if the response must be rebuilt. If only
+    measurement counters changed and the response is pinned, returns "late":
+    the response is still current unless its late statement finds a row, and
+    then gets new validators from revalidated_entry.
+    """
+
+    versions = entry["validated"][2]
+    current = table_versions(rows)
+    changed = [
+        table for table in set(versions) | set(current)
+        if versions.get(table) != current.get(table)
+    ]
+    if not changed:
+        return "current"
+    if entry["late"] is not None and all(
+        table.startswith("measurement") for table in changed
+    ):
+        return "late"
+    return "stale"
+
+def revalidated_entry(entry, rows):
+    """
+    Returns a copy of a cached entry with validators computed from the
+    current version rows.
+    """
+
+    tables, variant, versions = entry["validated"]
+    etag, last_modified = versions_validators(rows, variant)
+    headers = Headers(entry["headers"])
+    headers["ETag"] = quote_etag(etag)
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return dict(entry,
+        headers=list(headers),
+        validated=(tables, variant, table_versions(rows)),
+    )
+
+def revalidate_cached_response(entry):
+    """
+    Checks a cached response against the write counters of the tables it
+    was validated against before it is served, so that writes from other
+    processes, CLI commands and plain ORM code are not hidden behind the
+    cache. Costs the one small query of table_validators, and one more for
+    pinned pages after measurement writes. See ResponseCache.get.
+    """
+
+    if entry["validated"] is None or g.pop("response_cache_revalidated", False):
+        return entry
+    rows = db.session.execute(versions_statement(entry["validated"][0])).all()
+    state = revalidation_state(entry, rows)
+    if state == "late" and db.session.execute(entry["late"]).first() is None:
+        return revalidated_entry(entry, rows)
+    return entry if state == "current" else None
+
+class IngestQueue:
+    """
+    Bounded in-process queue for write-behind measurement ingestion. Request
+    handlers enqueue validated rows and return immediately; a background
+    writer thread takes up to flush_rows rows at a time, waiting at most
+    flush_interval seconds for a batch to fill, and stores each batch in one
+    transaction. Requests that would overflow the queue are rejected as a
+    whole so that the caller can retry them later. A batch that fails on a
+    transient database error is retried a few times before it is dropped,
+    and no failure stops the writer.
+
+    Rows still queued when the process exits are written by close, but rows
+    are lost if the process dies, so this mode trades durability for write
+    throughput.
+    """
+
+    def __init__(self, app, max_rows, flush_rows, flush_interval):
+        self.app = app
+        self.max_rows = max_rows
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rows = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closing = False
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def put(self, sensor, rows):
+        """
+        Enqueues rows for the named sensor. Returns False without enqueuing
+        anything if they do not fit in the queue.
+        """
+
+        with self.cond:
+            if len(self.rows) + len(rows) > self.max_rows:
+                self.rejected += 1
+                return False
+            self.rows.extend((sensor, row) for row in rows)
+            self.enqueued += len(rows)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name="ingest-writer", daemon=True
+                )
+                self.thread.start()
+            self.cond.notify()
+        return True
+
+    def take(self):
+        """
+        Waits for the next batch: flush_rows rows, or whatever arrived within
+        flush_interval of the first one. Returns an empty list once the queue
+        is closed and drained.
+        """
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.rows or self.closing)
+            self.cond.wait_for(
+                lambda: len(self.rows) >= self.flush_rows or self.closing,
+                timeout=self.flush_interval
+            )
+            size = min(len(self.rows), self.flush_rows)
+            return [self.rows.popleft() for i in range(size)]
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if not batch:
+                return
+            started = time.perf_counter()
+            stored = []
+            try:
+                with self.app.app_context():
+                    try:
+                        stored = self.write(batch)
+                        self.announce(batch, stored)
+                    finally:
+                        db.session.remove()
+            except Exception:
+                self.app.logger.exception("Failed to write %d queued measurements", len(batch))
+            elapsed = time.perf_counter() - started
+            with self.cond:
+                self.written += len(stored)
+                self.dropped += len(batch) - len(stored)
+                self.flushes += 1
+                self.flush_seconds += elapsed
+                self.last_flush_seconds = elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+                self.cond.notify_all()
+
+    def write(self, batch):
+        """
+        Stores one batch in a single transaction and returns the (sensor, row)
+        pairs it stored. Rows of sensors that were deleted after their
+        request was accepted are left out. The transaction is retried after
+        an OperationalError (a locked database or a lost connection) up to
+        INGEST_RETRIES times, with a growing delay, and a batch that still
+        fails is dropped as a whole and logged.
+        """
+
+        for attempt in itertools.count():
+            try:
+                sensor_ids = {row["sensor_id"] for sensor, row in batch}
+                existing = set(db.session.scalars(
+                    select(Sensor.id).where(Sensor.id.in_(sensor_ids))
+                ))
+                stored = [(sensor, row) for sensor, row in batch if row["sensor_id"] in existing]
+                rows = [row for sensor, row in stored]
+                for offset in range(0, len(rows), MEASUREMENT_INSERT_CHUNK):
+                    insert_measurements(rows[offset:offset + MEASUREMENT_INSERT_CHUNK])
+                db.session.commit()
+                return stored
+            except Exception as e:
+                db.session.rollback()
+                if not isinstance(e, OperationalError) or attempt == INGEST_RETRIES:
+                    self.app.logger.exception("Dropped %d queued measurements", len(batch))
+                    return []
+                self.app.logger.warning("Retrying %d queued measurements: %s", len(batch), e)
+            time.sleep(INGEST_RETRY_DELAY * 2 ** attempt)
+
+    @staticmethod
+    def announce(batch, stored):
+        """
+        Invalidates the cached measurements of every sensor in a written
+        batch, and publishes the rows that were stored.
+        """
+
+        earliest = {}
+        for sensor, row in batch:
+            if sensor not in earliest or row["time"] < earliest[sensor]:
+                earliest[sensor] = row["time"]
+        for sensor, time in earliest.items():
+            response_cache.invalidate("measurements:" + sensor, since=time)
+        published = defaultdict(list)
+        for sensor, row in stored:
+            published[sensor].append(row)
+        for sensor, rows in published.items():
+            measurement_hub.publish(sensor, rows)
+
+    def drain(self, timeout=None):
+        """
+        Blocks until every enqueued row has been written or dropped. Returns
+        False if the timeout ran out first.
+        """
+
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.written + self.dropped >= self.enqueued, timeout=timeout
+            )
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.rows),
+                "max_rows": self.max_rows,
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "rejected_requests": self.rejected,
+                "flushes": self.flushes,
+                "last_flush_ms": self.last_flush_seconds * 1000,
+                "max_flush_ms": self.max_flush_seconds * 1000,
+                "mean_flush_ms": self.flush_seconds * 1000 / max(self.flushes, 1),
+                "total_flush_ms": self.flush_seconds * 1000,
+            }
+
+class MeasurementHub:
+    """
+    In-process publish/subscribe hub for newly stored measurements. The
+    insert paths publish each committed batch once, already encoded as a
+    server-sent event, into the channel of its sensor, and every stream
+    subscribed to that sensor picks it up from the channel's short history.
+    A batch is encoded once whatever the number of subscribers, and a slow
+    subscriber never holds up the others: one that falls further behind
+    than the history reaches is told to reload instead.
+
+    Event ids are "<hub>-<sequence>", the hub part changing with every
+    process, so that a client reconnecting with a Last-Event-ID from another
+    process is told to reload too. Only measurements stored by this process
+    are published, so a deployment with several worker processes needs one
+    hub process in front, or a shared broker in its place.
+    """
+
+    def __init__(self, history, keepalive):
+        self.history = history
+        self.keepalive = keepalive
+        self.hub_id = "{:x}".format(random.getrandbits(32))
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.closing = False
+        self.published = 0
+
+    def join(self, sensor):
+        """
+        Returns the channel of the named sensor, creating it if needed, with
+        one more subscriber counted in. See leave.
+        """
+
+        with self.lock:
+            channel = self.channels.get(sensor)
+            if channel is None:
+                channel = self.channels[sensor] = {
+                    "cond": threading.Condition(),
+                    "events": deque(maxlen=self.history),
+                    "sequence": 0,
+                    "subscribers": 0,
+                    "notify": set(),
+                }
+            channel["subscribers"] += 1
+            return channel
+
+    def leave(self, sensor, channel):
+        """
+        Counts a subscriber out of a channel. The channel is removed with its
+        last subscriber, so that publish stops encoding rows nobody reads.
+        """
+
+        with self.lock:
+            channel["subscribers"] -= 1
+            if not channel["subscribers"] and self.channels.get(sensor) is channel:
+                del self.channels[sensor]
+
+    def subscribed(self, sensor):
+        """
+        Tells whether the named sensor has subscribers, that is whether
+        publish would do anything with its rows.
+        """
+
+        return sensor in self.channels
+
+    def publish(self, sensor, rows):
+        """
+        Publishes stored measurement rows (dictionaries with value and time)
+        of the named sensor. Does nothing unless the sensor has been
+        subscribed to. Must be called in an app context, after the rows have
+        been committed.
+        """
+
+        channel = self.channels.get(sensor)
+        if channel is None or not rows:
+            return
+        data = mason_encoder()([MEASUREMENT_ITEM.record(row["value"], row["time"]) for row in rows])
+        with channel["cond"]:
+            channel["sequence"] += 1
+            channel["events"].append((channel["sequence"], b"".join([
+                "id: {}-{}\nevent: measurements\ndata: ".format(
+                    self.hub_id, channel["sequence"]
+                ).encode("utf-8"),
+                data,
+                b"\n\n"
+            ])))
+            channel["cond"].notify_all()
+            notify = list(channel["notify"])
+        for callback in notify:
+            callback()
+        with self.lock:
+            self.published += 1
+
+    def subscribe(self, sensor, last_event_id, reload_href, notify=None):
+        """
+        Subscribes to the named sensor and returns the HubSubscription, which
+        must be closed when the stream ends.
+
+        : param str sensor: name of the sensor
+        : param str last_event_id: the Last-Event-ID request header, if any
+        : param str reload_href: where the client should reload from after a gap
+        : param callable notify: called without arguments, from the
+            publishing thread, whenever there is something new to take
+        """
+
+        return HubSubscription(self, sensor, last_event_id, reload_href, notify)
+
+    def stream(self, sensor, last_event_id, reload_href):
+        """
+        Yields the server-sent events of the named sensor published after the
+        given Last-Event-ID, or after now if there is none, with a comment
+        line every keepalive seconds while nothing happens. Ends when the hub
+        is closed. Arguments are as for subscribe.
+        """
+
+        subscription = self.subscribe(sensor, last_event_id, reload_href)
+        try:
+            yield subscription.opening()
+            while not self.closing:
+                subscription.wait(self.keepalive)
+                frames = subscription.take()
+                yield b": keepalive\n\n" if frames is None else frames
+        finally:
+            subscription.close()
+
+    def close(self):
+        self.closing = True
+        with self.lock:
+            channels = list(self.channels.values())
+        for channel in channels:
+            with channel["cond"]:
+                channel["cond"].notify_all()
+                notify = list(channel["notify"])
+            for callback in notify:
+                callback()
+
+    def stats(self):
+        with self.lock:
+            channels = list(self.channels.values())
+        return {
+            "channels": len(channels),
+            "subscribers": sum(channel["subscribers"] for channel in channels),
+            "published": self.published,
+        }
+
+class HubSubscription:
+    """
+    One subscriber's position in a channel of a MeasurementHub. The hub's
+    stream generator waits for events with wait, while servers that do not
+    block a thread per stream (see asgi.py) pass a notify callable to
+    MeasurementHub.subscribe instead and call take when it fires.
+    """
+
+    def __init__(self, hub, sensor, last_event_id, reload_href, notify):
+        self.hub = hub
+        self.sensor = sensor
+        self.channel = channel = hub.join(sensor)
+        self.last_event_id = last_event_id
+        self.notify = notify
+        self.reload_event = "event: reload\ndata: {}\n\n".format(
+            json.dumps({"href": reload_href})
+        ).encode("utf-8")
+        with channel["cond"]:
+            if notify is not None:
+                channel["notify"].add(notify)
+            self.last = channel["sequence"]
+
+    def opening(self):
+        """
+        Returns the first frames of the stream: the retry interval, and a
+        reload event if the Last-Event-ID cannot be resumed from.
+        """
+
+        frames = "retry: {}\n\n".format(int(self.hub.keepalive * 1000)).encode("utf-8")
+        if self.last_event_id:
+            hub_id, _, sequence = self.last_event_id.partition("-")
+            if hub_id == self.hub.hub_id and sequence.isdigit() and int(sequence) <= self.last:
+                self.last = int(sequence)
+            else:
+                frames += self.reload_event
+        return frames
+
+    def wait(self, timeout):
+        with self.channel["cond"]:
+            self.channel["cond"].wait_for(
+                lambda: self.channel["sequence"] > self.last or self.hub.closing,
+                timeout=timeout
+            )
+
+    def take(self):
+        """
+        Returns the frames published since the last call, a reload event if
+        some of them have already left the history, or None if there is
+        nothing new.
+        """
+
+        channel = self.channel
+        with channel["cond"]:
+            events = channel["events"]
+            if channel["sequence"] == self.last:
+                frames = None
+            elif events and events[0][0] > self.last + 1:
+                frames = self.reload_event
+            else:
+                frames = b"".join(frame for number, frame in events if number > self.last)
+            self.last = channel["sequence"]
+        return frames
+
+    def close(self):
+        with self.channel["cond"]:
+            self.channel["notify"].discard(self.notify)
+        self.hub.leave(self.sensor, self.channel)
+
+def create_partitioned_measurements():
+    """
+    Creates the measurement table on PostgreSQL as a table partitioned by
+    range of time, with a default partition for rows outside every monthly
+    partition (see the add-partitions command). The sensor and location
+    tables it refers to are created first. PostgreSQL requires the
+    partition key in the primary key, so the table's key is (id, time) while
+    the model keeps using id alone as its identity.
+    """
+
+    metadata = MetaData()
+    for model in (Location, Sensor):
+        model.__table__.to_metadata(metadata)
+    table = Measurement.__table__.to_metadata(metadata)
+    table.c.id.autoincrement = True
+    table.c.time.primary_key = True
+    table.append_constraint(PrimaryKeyConstraint(table.c.id, table.c.time))
+    table.dialect_kwargs["postgresql_partition_by"] = "RANGE (time)"
+    metadata.create_all(db.engine)
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS {0}_default PARTITION OF {0} DEFAULT".format(table.name)
+        ))
+
+def is_partitioned(table_name):
+    if db.engine.dialect.name != "postgresql":
+        return False
+    return db.session.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name)"),
+        {"name": table_name}
+    ).first() is not None
+
+def add_months(moment, months):
+    month = moment.month - 1 + months
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1, day=1)
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Adds the time spent in the enclosed block to the named span of the
+    current request, see record_span.
+    """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+def record_span(name, seconds):
+    """
+    Adds seconds to the named span of the current request. Spans are kept
+    flat: db, validate and serialize never contain one another, and whatever
+    is left of the request's time is reported as app. Does nothing outside
+    requests.
+    """
+
+    if has_request_context():
+        spans = g.get("spans")
+        if spans is not None:
+            spans[name] += seconds
+
+def encode_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, MasonRecord):
+        return obj.expand()
+    raise TypeError("{} is not JSON serializable".format(type(obj).__name__))
+
+_stdlib_encoder = json.JSONEncoder(separators=(",", ":"), default=encode_default)
+
+def encode_stdlib(obj):
+    return _stdlib_encoder.encode(obj).encode("utf-8")
+
+def encode_orjson(obj):
+    return orjson.dumps(obj, default=encode_default)
+
+# Mason body encoders by name. Each turns a JSON serializable object, which
+# may also contain datetimes, into compact UTF-8 bytes. The MASON_ENCODER
+# setting picks one, "auto" meaning orjson when it is installed.
+MASON_ENCODERS = {"json": encode_stdlib}
+if orjson is not None:
+    MASON_ENCODERS["orjson"] = encode_orjson
+
+# Encoders for which splicing a MasonRecord's encoded values into its
+# template's pre-encoded segments beats encoding the expanded record. The
+# stdlib encoder has a high cost per object, orjson has not.
+SPLICING_ENCODERS = {encode_stdlib}
+
+def mason_encoder():
+    return current_app.extensions["sensorhub"]["encode"]
+
+def dumps(obj):
+    with span("serialize"):
+        return mason_encoder()(obj)
+
+def compile_validator(schema, generate_code=True):
+    """
+    Compiles a JSON schema once into a function that raises ValidationError
+    for invalid documents. Uses fastjsonschema's generated code when it is
+    installed and generate_code is set, otherwise a jsonschema validator
+    whose schema has been checked against the meta-schema up front.
+    """
+
+    if generate_code and fastjsonschema is not None:
+        check = fastjsonschema.compile(schema)
+
+        def validate(doc):
+            try:
+                check(doc)
+            except fastjsonschema.JsonSchemaValueException as e:
+                raise ValidationError(e.message)
+
+        return validate
+
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+
+    def validate(doc):
+        error = best_match(validator.iter_errors(doc))
+        if error is not None:
+            raise error
+
+    return validate
+
+@functools.lru_cache(maxsize=None)
+def model_validator(model):
+    return compile_validator(model.get_schema())
+
+def validate_document(doc, model):
+    """
+    Validates a request document against the given model's schema with the
+    model's cached compiled validator.
+    """
+
+    with span("validate"):
+        model_validator(model)(doc)
+
+class RequestMetrics:
+    """
+    Request counts, latency histograms, span totals and SQL statement counts
+    per endpoint, kept in process memory and rendered in the Prometheus text
+    format. Each worker process keeps its own numbers, so scrapes are per
+    process.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.histograms = {}
+        self.spans = defaultdict(float)
+        self.statements = defaultdict(int)
+
+    def observe(self, endpoint, method, status, seconds, spans, statements):
+        with self.lock:
+            self.requests[endpoint, method, status] += 1
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = [0] * len(self.BUCKETS) + [0, 0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            for name, value in spans.items():
+                self.spans[endpoint, name] += value
+            self.statements[endpoint] += statements
+
+    def render(self, gauges, counters):
+        """
+        Renders every metric, followed by the given gauges and counters
+        (dictionaries of metric name to value), in the Prometheus text
+        exposition format.
+        """
+
+        lines = [
+            "# HELP sensorhub_requests_total Requests handled",
+            "# TYPE sensorhub_requests_total counter",
+        ]
+        with self.lock:
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append('sensorhub_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(
+                    endpoint, method, status, count
+                ))
+            lines += [
+                "# HELP sensorhub_request_duration_seconds Request latency including streamed bodies",
+                "# TYPE sensorhub_request_duration_seconds histogram",
+            ]
+            for endpoint, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.BUCKETS, histogram):
+                    lines.append('sensorhub_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        endpoint, bound, count
+                    ))
+                lines.append('sensorhub_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'.format(
+                    endpoint, histogram[-2]
+                ))
+                lines.append('sensorhub_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(
+                    endpoint, histogram[-1]
+                ))
+                lines.append('sensorhub_request_duration_seconds_count{{endpoint="{}"}} {}'.format(
+                    endpoint, histogram[-2]
+                ))
+            lines += [
+                "# HELP sensorhub_span_seconds_total Time spent in db, validate and serialize spans",
+                "# TYPE sensorhub_span_seconds_total counter",
+            ]
+            for (endpoint, name), seconds in sorted(self.spans.items()):
+                lines.append('sensorhub_span_seconds_total{{endpoint="{}",span="{}"}} {}'.format(
+                    endpoint, name, seconds
+                ))
+            lines += [
+                "# HELP sensorhub_sql_statements_total SQL statements executed by requests",
+                "# TYPE sensorhub_sql_statements_total counter",
+            ]
+            for endpoint, count in sorted(self.statements.items()):
+                lines.append('sensorhub_sql_statements_total{{endpoint="{}"}} {}'.format(
+                    endpoint, count
+                ))
+        for kind, metrics in (("gauge", gauges), ("counter", counters)):
+            for name, value in metrics.items():
+                lines.append("# TYPE {} {}".format(name, kind))
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+class SlowestProfiles:
+    """
+    Keeps cProfile dumps of the slowest sampled requests in a directory. A
+    dump is deleted when a slower request pushes it out of the slowest
+    keep. The dumps can be read with pstats or snakeviz.
+    """
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self.heap = []
+        self.serial = 0
+        self.lock = threading.Lock()
+
+    def offer(self, profiler, seconds, label):
+        with self.lock:
+            if len(self.heap) >= self.keep and seconds <= self.heap[0][0]:
+                return
+            self.serial += 1
+            path = os.path.join(self.directory, "{:.0f}ms-{}-{}.prof".format(
+                seconds * 1000, re.sub(r"[^\w.-]+", "_", label), self.serial
+            ))
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(path)
+            heapq.heappush(self.heap, (seconds, path))
+            if len(self.heap) > self.keep:
+                _, evicted = heapq.heappop(self.heap)
+                os.remove(evicted)
+
+def event_stream_response(events):
+    """
+    Wraps an iterable of server-sent event frames into a streamed response
+    that proxies pass on without buffering.
+    """
+
+    return Response(events, 200, mimetype=EVENT_STREAM, headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+def create_error_response(status_code, title, message=None):
+    resource_url = request.path
+    body = MasonBuilder(resource_url=resource_url)
+    body.add_error(title, message)
+    body.add_control("profile", href=ERROR_PROFILE)
+    return Response(dumps(body), status_code, mimetype=MASON)
+
+# ^
+# |
+# UTILS
+# RESOURCES
+# |
+# v
+
+class SensorCollection(Resource):
+
+    def get(self):
+        validators = table_validators("sensor", "location")
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        cache_as("sensors")
+        body = sensor_collection_body()
+
+        # The statement runs here rather than in the generator so that it is
+        # executed, and counted, before the response starts streaming. It
+        # gets a connection of its own: Flask ends the request's session when
+        # the view returns, and stream_with_context only restores the context
+        # around the body, so a server-side cursor of the session would be
+        # gone by then. The connection is closed with the response.
+        connection = db.engine.connect()
+        try:
+            rows = connection.execute(
+                sensor_collection_statement().execution_options(yield_per=STREAM_BATCH_SIZE)
+            )
+        except Exception:
+            connection.close()
+            raise
+
+        response = Response(
+            stream_with_context(body.iter_json(sensor_items(rows))), 200, mimetype=MASON
+        )
+        response.call_on_close(connection.close)
+        return add_validators(response, validators)
+
+    def post(self):
+        if not request.json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate_document(request.json, Sensor)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        sensor = Sensor(
+            name=request.json["name"],
+            model=request.json["model"],
+        )
+
+        try:
+            db.session.add(sensor)
+            db.session.commit()
+        except IntegrityError:
+            return create_error_response(409, "Already exists", 
+                "Sensor with name '{}' already exists.".format(request.json["name"])
+            )
+        response_cache.invalidate("sensors")
+
+        return Response(status=201, headers={
+            "Location": api.url_for(SensorItem, sensor=request.json["name"])
+        })
+
+
+class SensorItem(Resource):
+
+    def get(self, sensor):
+        validators = table_validators("sensor", "location")
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        cache_as("sensor:" + sensor)
+        row = db.session.execute(sensor_item_statement(sensor)).first()
+        if row is None:
+            return create_error_response(404, "Not found", 
+                "No sensor was found with the name {}".format(sensor)
+            )
+        
+        body = sensor_item_body(*row)
+        return add_validators(
+            Response(dumps(body), 200, mimetype=MASON),
+            validators
+        )
+    
+    def put(self, sensor):
+        db_sensor = Sensor.query.filter_by(name=sensor).first()
+        if db_sensor is None:
+            return create_error_response(404, "Not found", 
+                "No sensor was found with the name {}".format(sensor)
+            )
+        
+        if not request.json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate_document(request.json, Sensor)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+    
+        db_sensor.name = request.json["name"]
+        db_sensor.model = request.json["model"]
+        
+        try:
+            db.session.commit()
+        except IntegrityError:
+            return create_error_response(409, "Already exists", 
+                "Sensor with name '{}' already exists.".format(request.json["name"])
+            )
+        response_cache.invalidate("sensors", "sensor:" + sensor)
+
+        return Response(status=204)
+
+    def delete(self, sensor):
+        db_sensor = Sensor.query.filter_by(name=sensor).first()
+        if db_sensor is None:
+            return create_error_response(404, "Not found", 
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        delete_rollups(db_sensor.id)
+        db.session.delete(db_sensor)
+        db.session.commit()
+        response_cache.invalidate("sensors", "sensor:" + sensor)
+
+        return Response(status=204)
+
+
+class SensorBatch(Resource):
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_schema():
+        """
+        Schema of one operation. The request body is an array of them, see
+        SensorhubBuilder._batch_schema.
+        """
+
+        schema = {
+            "type": "object",
+            "required": ["op"],
+            "allOf": [
+                {
+                    "if": {"properties": {"op": {"const": "create"}}},
+                    "then": {"required": ["name", "model"]}
+                },
+                {
+                    "if": {"properties": {"op": {"const": "update"}}},
+                    "then": {"required": ["sensor", "name", "model"]}
+                },
+                {
+                    "if": {"properties": {"op": {"const": "delete"}}},
+                    "then": {"required": ["sensor"]}
+                },
+            ]
+        }
+        props = schema["properties"] = {}
+        props["op"] = {
+            "description": "What to do",
+            "enum": ["create", "update", "delete"]
+        }
+        props["sensor"] = {
+            "description": "Name of the sensor to update or delete",
+            "type": "string"
+        }
+        props.update(Sensor.get_schema()["properties"])
+        return schema
+
+    def post(self):
+        operations = request.get_json(silent=True)
+        if not isinstance(operations, list):
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be a JSON array of operations"
+            )
+        if not operations or len(operations) > MAX_BATCH_OPERATIONS:
+            return create_error_response(400, "Invalid JSON document",
+                "A batch must have between 1 and {} operations".format(MAX_BATCH_OPERATIONS)
+            )
+
+        errors = []
+        for index, op in enumerate(operations):
+            try:
+                validate_document(op, SensorBatch)
+            except ValidationError as e:
+                errors.append((index, e.message))
+        status = 400
+        if not errors:
+            names = set()
+            for op in operations:
+                names.update(op[key] for key in ("sensor", "name") if key in op)
+            existing = dict(db.session.execute(
+                select(Sensor.name, Sensor.id).where(Sensor.name.in_(names))
+            ).all())
+            errors, deletes, updates, creates = plan_sensor_batch(operations, existing)
+            status = 409
+
+        if errors:
+            body = MasonBuilder(resource_url=request.path, errors=[
+                {"index": index, "message": message} for index, message in errors
+            ])
+            body.add_error("Invalid operations",
+                "{} of {} operations were rejected, nothing was changed".format(
+                    len(errors), len(operations)
+                )
+            )
+            body.add_control("profile", href=ERROR_PROFILE)
+            return Response(dumps(body), status, mimetype=MASON)
+
+        original = {key: name for name, key in existing.items()}
+        try:
+            apply_sensor_batch(deletes, updates, creates, original)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(409, "Conflict",
+                "The sensors were modified while the batch was applied, nothing was changed"
+            )
+        response_cache.invalidate(*{"sensors"} | {"sensor:" + name for name in names})
+
+        body = SensorhubBuilder()
+        body.add_namespace("senhub", LINK_RELATIONS_URL)
+        body.add_control("self", cached_url_for(SensorBatch))
+        body.add_control("collection", cached_url_for(SensorCollection))
+        results = body["results"] = []
+        for index, op in enumerate(operations):
+            result = MasonBuilder(index=index, op=op["op"])
+            if op["op"] == "delete":
+                result["status"] = 204
+            else:
+                result["status"] = 201 if op["op"] == "create" else 204
+                result.add_control("item", cached_url_for(SensorItem, sensor=op["name"]))
+            results.append(result)
+        return Response(dumps(body), 200, mimetype=MASON)
+
+
+class LocationItem(Resource):
+
+    def get(self, location):
+        return create_error_response(501, "Unimplemented")
+
+
+class MeasurementCollection(Resource):
+
+    def get(self, sensor):
+        mimetype = request.accept_mimetypes.best_match(export_media_types(), default=MASON)
+        validators = table_validators(
+            "sensor", "measurement", sensor_measurement_version(sensor), variant=mimetype
+        )
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        db_sensor = Sensor.query.filter_by(name=sensor).first()
+        if db_sensor is None:
+            return create_error_response(404, "Not found", 
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        try:
+            args = measurement_page_args()
+        except ValueError:
+            return create_error_response(400, "Invalid query string value")
+
+        criteria = measurement_criteria(db_sensor.id, args)
+        if mimetype != MASON:
+            return self._export(criteria, mimetype, validators)
+        mark = db.session.scalar(measurement_mark_statement())
+        page, has_prev, has_next = paginate_measurements(criteria, args["start"], args["position"])
+        pinned = measurement_page_pin(page, has_next, args)
+        cache_as("sensor:" + sensor, "measurements:" + sensor, pinned=pinned,
+            late=None if pinned is None else late_measurement_statement(criteria, pinned, mark)
+        )
+
+        body = measurement_page_body(sensor, page, has_prev, has_next, args)
+        if args["with_total"]:
+            body["total"] = db.session.scalar(count_statement(criteria))
+
+        items = measurement_items(page)
+        response = Response(stream_with_context(body.iter_json(items)), 200, mimetype=MASON)
+        response.vary.add("Accept")
+        return add_validators(response, validators)
+
+    @staticmethod
+    def _export(criteria, mimetype, validators):
+        """
+        Serves the whole (optionally time windowed) measurement history in a
+        columnar binary format, streamed from the database cursor in batches.
+        Paging parameters do not apply to these representations.
+        """
+
+        if mimetype == NPY:
+            count = db.session.scalar(count_statement(criteria))
+            chunks = iter_npy(count, iter_measurement_columns(criteria))
+        else:
+            chunks = iter_arrow(iter_measurement_columns(criteria))
+        response = Response(stream_with_context(chunks), 200, mimetype=mimetype)
+        response.vary.add("Accept")
+        return add_validators(response, validators)
+
+    def post(self, sensor):
+        db_sensor = Sensor.query.filter_by(name=sensor).first()
+        if db_sensor is None:
+            return create_error_response(404, "Not found", 
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        # errors point at NDJSON documents by line and at JSON ones by index
+        if request.mimetype == NDJSON:
+            position = "line"
+            readings = read_ndjson(request.stream)
+        else:
+            doc = request.get_json(silent=True)
+            if doc is None:
+                return create_error_response(415, "Unsupported media type",
+                    "Requests must be JSON or NDJSON"
+                )
+            position = "index"
+            readings = (
+                (index, reading, None)
+                for index, reading in enumerate(doc if isinstance(doc, list) else [doc])
+            )
+
+        write_behind = current_app.config["INGEST_WRITE_BEHIND"]
+        errors = []
+        chunk = []
+        # rows of chunks already inserted, kept for publishing if needed
+        flushed = [] if measurement_hub.subscribed(sensor) else None
+        count = 0
+        earliest = None
+        for number, doc, error in readings:
+            if error is None:
+                try:
+                    validate_document(doc, Measurement)
+                    row = parse_measurement(doc, db_sensor.id)
+                except ValidationError as e:
+                    error = e.message
+                except ValueError as e:
+                    error = str(e)
+            count += 1
+            if error is not None:
+                errors.append({position: number, "message": error})
+            elif not errors:
+                chunk.append(row)
+                if earliest is None or row["time"] < earliest:
+                    earliest = row["time"]
+                if not write_behind and len(chunk) >= MEASUREMENT_INSERT_CHUNK:
+                    insert_measurements(chunk)
+                    if flushed is not None:
+                        flushed.extend(chunk)
+                    chunk = []
+
+        if count == 0:
+            return create_error_response(400, "Invalid JSON document",
+                "No measurements were sent"
+            )
+        if errors:
+            db.session.rollback()
+            body = MasonBuilder(resource_url=request.path, errors=errors)
+            body.add_error("Invalid measurements",
+                "{} of {} measurements were rejected, nothing was stored".format(
+                    len(errors), count
+                )
+            )
+            body.add_control("profile", href=ERROR_PROFILE)
+            return Response(dumps(body), 400, mimetype=MASON)
+
+        body = SensorhubBuilder(accepted=count)
+        body.add_namespace("senhub", LINK_RELATIONS_URL)
+        body.add_control("up", api.url_for(SensorItem, sensor=sensor))
+        body.add_control("collection", api.url_for(MeasurementCollection, sensor=sensor))
+
+        if write_behind:
+            if len(chunk) > ingest_queue.max_rows:
+                return create_error_response(413, "Request entity too large",
+                    "At most {} measurements can be queued in one request".format(
+                        ingest_queue.max_rows
+                    )
+                )
+            if not ingest_queue.put(sensor, chunk):
+                response = create_error_response(429, "Too many requests",
+                    "The ingestion queue is full, try again later"
+                )
+                response.headers["Retry-After"] = "1"
+                return response
+            return Response(dumps(body), 202, mimetype=MASON)
+
+        insert_measurements(chunk)
+        db.session.commit()
+        response_cache.invalidate("measurements:" + sensor, since=earliest)
+        measurement_hub.publish(sensor, chunk if not flushed else flushed + chunk)
+        return Response(dumps(body), 201, mimetype=MASON, headers={
+            "Location": api.url_for(MeasurementCollection, sensor=sensor)
+        })
+
+
+class MeasurementSubscription(Resource):
+    """
+    Streams the measurements of a sensor stored from now on as server-sent
+    events, one "measurements" event per stored batch with an array of
+    items as its data. A client reconnecting with Last-Event-ID gets what it
+    missed, or a "reload" event pointing at the measurement collection if
+    that is no longer known.
+
+    Every open stream occupies a worker for as long as it stays open, so
+    serve many subscribers with a worker type that makes idle connections
+    cheap, e.g. gunicorn -k gevent, whose monkey patching turns the hub's
+    waits into greenlet switches, or in ASGI mode, where streams are served
+    by coroutines.
+    """
+
+    def get(self, sensor):
+        db_sensor = Sensor.query.filter_by(name=sensor).first()
+        if db_sensor is None:
+            return create_error_response(404, "Not found",
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        events = measurement_hub.stream(
+            sensor,
+            request.headers.get("Last-Event-ID"),
+            cached_url_for(MeasurementCollection, sensor=sensor)
+        )
+        return event_stream_response(events)
+
+
+class MeasurementAggregate(Resource):
+
+    def get(self, sensor):
+        validators = table_validators(
+            "sensor", "measurement", sensor_measurement_version(sensor)
+        )
+        not_modified = not_modified_response(validators)
+        if not_modified is not None:
+            return not_modified
+
+        db_sensor = Sensor.query.filter_by(name=sensor).first()
+        if db_sensor is None:
+            return create_error_response(404, "Not found", 
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        # the control template expands unfilled variables to empty values
+        method = request.args.get("method") or "stats"
+        try:
+            start = datetime.datetime.strptime(request.args["start"], TIMESTAMP_FORMAT)
+            end = datetime.datetime.strptime(request.args["end"], TIMESTAMP_FORMAT)
+            size = parse_bucket(request.args.get("bucket") or "1h")
+        except (KeyError, ValueError):
+            return create_error_response(400, "Invalid query string value",
+                "start and end must be timestamps like 2020-01-01T00:00:00Z "
+                "and bucket a size like 1m or 1h"
+            )
+        if method not in AGGREGATE_METHODS:
+            return create_error_response(400, "Invalid query string value",
+                "method must be one of {}".format(", ".join(AGGREGATE_METHODS))
+            )
+        if end <= start or (end - start).total_seconds() / size > MAX_AGGREGATE_BUCKETS:
+            return create_error_response(400, "Invalid query string value",
+                "The window must be non-empty and span at most {} buckets".format(
+                    MAX_AGGREGATE_BUCKETS
+                )
+            )
+
+        cache_as("sensor:" + sensor, "measurements:" + sensor)
+        if method == "stats":
+            items = aggregate_measurements(db_sensor.id, start, end, size)
+        elif np is None:
+            return create_error_response(501, "Not implemented",
+                "The {} method requires NumPy, which is not installed".format(method)
+            )
+        else:
+            items = aggregate_measurements_numpy(db_sensor.id, start, end, size, method)
+
+        body = SensorhubBuilder()
+        body.add_namespace("senhub", LINK_RELATIONS_URL)
+        body.add_control("self", request.full_path)
+        body.add_control("up", cached_url_for(MeasurementCollection, sensor=sensor))
+        body.add_control_aggregate_measurements(sensor)
+        body["items"] = items
+        return add_validators(
+            Response(dumps(body), 200, mimetype=MASON),
+            validators
+        )
+
+# ^
+# |
+# RESOURCES
+# ROUTES & CLI
+# |
+# v
+
+@api_bp.before_request
+def serve_from_cache():
+    if request.method != "GET" or not response_cache.max_bytes:
+        return None
+    entry = response_cache.get(response_cache.request_key(), revalidate_cached_response)
+    if entry is None:
+        return None
+    response = Response(entry["body"], entry["status"], headers=entry["headers"])
+    response.headers["X-Cache"] = "HIT"
+    return response.make_conditional(request)
+
+@api_bp.after_request
+def store_in_cache(response):
+    tags = g.pop("response_cache_tags", None)
+    if (
+        tags and request.method == "GET" and response.status_code == 200
+        and response_cache.max_bytes and "X-Cache" not in response.headers
+    ):
+        response.headers["X-Cache"] = "MISS"
+        response_cache.store(
+            response_cache.request_key(), response, tags,
+            g.pop("response_cache_pinned", None), g.pop("response_validated", None),
+            g.pop("response_cache_late", None)
+        )
+    return response
+
+api.add_resource(SensorCollection, "/sensors/")
+api.add_resource(SensorItem, "/sensors/<sensor>/")
+api.add_resource(SensorBatch, "/batch/sensors/")
+api.add_resource(LocationItem, "/locations/<location>/")
+api.add_resource(MeasurementCollection, "/sensors/<sensor>/measurements/")
+api.add_resource(MeasurementAggregate, "/sensors/<sensor>/measurements/aggregate/")
+api.add_resource(MeasurementSubscription, "/sensors/<sensor>/measurements/stream/")
+
+@site_bp.route("/stats/cache/")
+def send_cache_stats():
+    return jsonify(response_cache.stats())
+
+@site_bp.route("/stats/ingest/")
+def send_ingest_stats():
+    return jsonify(ingest_queue.stats())
+
+@site_bp.route("/stats/subscriptions/")
+def send_subscription_stats():
+    return jsonify(measurement_hub.stats())
+
+@site_bp.route("/metrics")
+def send_metrics():
+    cache = response_cache.stats()
+    ingest = ingest_queue.stats()
+    gauges = {
+        "sensorhub_response_cache_entries": cache["entries"],
+        "sensorhub_response_cache_bytes": cache["bytes"],
+        "sensorhub_ingest_queue_depth": ingest["depth"],
+        "sensorhub_ingest_last_flush_seconds": ingest["last_flush_ms"] / 1000,
+        "sensorhub_ingest_max_flush_seconds": ingest["max_flush_ms"] / 1000,
+    }
+    counters = {
+        "sensorhub_response_cache_hits_total": cache["hits"],
+        "sensorhub_response_cache_misses_total": cache["misses"],
+        "sensorhub_response_cache_evictions_total": cache["evictions"],
+        "sensorhub_response_cache_stale_total": cache["stale"],
+        "sensorhub_ingest_rejected_requests_total": ingest["rejected_requests"],
+        "sensorhub_ingest_written_rows_total": ingest["written"],
+        "sensorhub_ingest_dropped_rows_total": ingest["dropped"],
+        "sensorhub_ingest_flushes_total": ingest["flushes"],
+        "sensorhub_ingest_flush_seconds_total": ingest["total_flush_ms"] / 1000,
+    }
+    return Response(request_metrics.render(gauges, counters),
+        content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+@site_bp.before_app_request
+def start_request_timer():
+    """
+    Starts timing the request, and with probability PROFILE_SAMPLE_RATE
+    starts profiling it as well.
+    """
+
+    g.request_started = time.perf_counter()
+    g.spans = defaultdict(float)
+    rate = current_app.config["PROFILE_SAMPLE_RATE"]
+    if rate and random.random() < rate:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@site_bp.after_app_request
+def finish_request_timer(response):
+    """
+    Reports the request's spans in a Server-Timing header and records the
+    request in the metrics. Streamed bodies are produced after this point,
+    so their header only covers the time until the response started, while
+    the metrics and profile are recorded once the body has been sent.
+    """
+
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    spans = g.spans
+    if current_app.config["SERVER_TIMING"]:
+        elapsed = time.perf_counter() - started
+        timings = [
+            "{};dur={:.2f}".format(name, seconds * 1000) for name, seconds in spans.items()
+        ]
+        timings.append("app;dur={:.2f}".format((elapsed - sum(spans.values())) * 1000))
+        timings.append("total;dur={:.2f}".format(elapsed * 1000))
+        response.headers["Server-Timing"] = ", ".join(timings)
+
+    state = g._get_current_object()
+    metrics = current_app.extensions["sensorhub"]["metrics"]
+    profiles = current_app.extensions["sensorhub"]["profiles"]
+    profiler = g.pop("profiler", None)
+    endpoint = request.endpoint or "unmatched"
+    method = request.method
+    status = response.status_code
+
+    def finish():
+        seconds = time.perf_counter() - started
+        if profiler is not None:
+            profiler.disable()
+            profiles.offer(profiler, seconds, "{}-{}".format(method, endpoint))
+        metrics.observe(
+            endpoint, method, status, seconds, spans, state.get("sql_statements", 0)
+        )
+
+    if response.is_streamed:
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+@site_bp.after_app_request
+def add_sql_statement_count(response):
+    """
+    In debug mode, reports the number of SQL statements the request executed
+    in an X-SQL-Statements header so that N+1 query regressions show up.
+    """
+
+    if current_app.debug:
+        response.headers["X-SQL-Statements"] = str(g.get("sql_statements", 0))
+    return response
+
+@site_bp.route(LINK_RELATIONS_URL)
+def send_link_relations():
+    return "link relations"
+
+@site_bp.route("/profiles/<profile>/")
+def send_profile(profile):
+    return "you requests {} profile".format(profile)
+
+@site_bp.route("/admin/")
+def admin_site():
+    return current_app.send_static_file("html/admin.html")
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    if current_app.config["PARTITION_MEASUREMENTS"] and db.engine.dialect.name == "postgresql":
+        create_partitioned_measurements()
+    db.create_all()
+
+@click.command("add-partitions")
+@click.option("--start", required=True, type=click.DateTime(["%Y-%m"]),
+    help="first month to add, as YYYY-MM"
+)
+@click.option("--months", default=12, show_default=True)
+@with_appcontext
+def add_partitions_command(start, months):
+    """
+    Adds monthly partitions to a partitioned measurement table on PostgreSQL.
+    Existing partitions are skipped. Rows for months without a partition
+    land in measurement_default.
+    """
+
+    if not is_partitioned(Measurement.__table__.name):
+        raise click.ClickException(
+            "The measurement table is not partitioned, see PARTITION_MEASUREMENTS"
+        )
+    for i in range(months):
+        lower = add_months(start, i)
+        upper = add_months(start, i + 1)
+        name = "{}_y{:04d}m{:02d}".format(Measurement.__table__.name, lower.year, lower.month)
+        db.session.execute(text(
+            "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+            "FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, Measurement.__table__.name, lower.date(), upper.date()
+            )
+        ))
+        click.echo("{}: {} to {}".format(name, lower.date(), upper.date()))
+    db.session.commit()
+
+@click.command("migrate-indexes")
+@with_appcontext
+def migrate_indexes_command():
+    """
+    Brings an existing database up to the declared schema: creates missing
+    tables (such as table_version and the rollup tables added after the
+    first release) together with their indexes, and any declared index that
+    is missing from an existing table. Existing tables and their data are
+    left untouched. New rollup tables start empty, so the command ends with
+    a reminder to run rebuild-rollups when it created any.
+    """
+
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            table.create(bind=db.engine, checkfirst=True)
+            created.append(table.name)
+            click.echo("{}: created table".format(table.name))
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                click.echo("{}: {} already exists".format(table.name, index.name))
+            else:
+                index.create(bind=db.engine)
+                click.echo("{}: created {}".format(table.name, index.name))
+    if {rollup.__tablename__ for rollup in ROLLUPS} & set(created):
+        click.echo("Rollup tables were created empty, run rebuild-rollups to fill them")
+
+@click.command("check-query-plans")
+@with_appcontext
+def check_query_plans_command():
+    """
+    Runs EXPLAIN QUERY PLAN for each hot query and exits with an error if any
+    of them falls back to a full table scan or sorts its results in a
+    temporary B-tree instead of reading them in index order.
+    """
+
+    if db.engine.dialect.name != "sqlite":
+        raise click.ClickException("Query plan checks are only implemented for SQLite")
+
+    failed = []
+    for name, statement in hot_queries():
+        sql = statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        plan = [
+            row[-1] for row in
+            db.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN {}".format(sql))
+        ]
+        bad = [
+            step for step in plan
+            if (step.startswith("SCAN ") and " INDEX " not in step)
+            or step.startswith("USE TEMP B-TREE")
+        ]
+        click.echo("{}: {}".format(name, "; ".join(plan)))
+        if bad:
+            failed.append(name)
+
+    if failed:
+        raise click.ClickException(
+            "Full scan in hot queries: {}".format(", ".join(failed))
+        )
+
+@click.command("testgen")
+@click.option("--sensors", default=1, show_default=True, help="sensors to create")
+@click.option("--readings", default=1000, show_default=True, help="measurements per sensor")
+@click.option("--interval", default=10.0, show_default=True,
+    help="seconds between measurements"
+)
+@click.option("--distribution", default="uniform", show_default=True,
+    type=click.Choice(TESTGEN_DISTRIBUTIONS), help="how values are drawn"
+)
+@click.option("--start", type=click.DateTime(),
+    help="time of the first measurement [default: now]"
+)
+@click.option("--prefix", default="test-sensor", show_default=True,
+    help="sensor names are prefix-1, prefix-2, ..."
+)
+@click.option("--seed", type=int, help="random seed for reproducible data")
+@click.option("--chunk-size", default=TESTGEN_CHUNK, show_default=True,
+    help="measurements inserted per transaction"
+)
+@with_appcontext
+def generate_test_data(sensors, readings, interval, distribution, start, prefix, seed, chunk_size):
+    """
+    Creates sensors with generated measurement series at a fixed interval.
+    Timestamps and values are built with NumPy a chunk at a time and written
+    with bulk inserts, and the rollup tables are filled from the same arrays
+    so rebuild-rollups is not needed afterwards.
+    """
+
+    if np is None:
+        raise click.ClickException("testgen requires NumPy")
+    names = ["{}-{}".format(prefix, i + 1) for i in range(sensors)]
+    taken = db.session.scalars(select(Sensor.name).where(Sensor.name.in_(names))).all()
+    if taken:
+        raise click.ClickException("Sensors already exist: {}".format(", ".join(taken)))
+
+    rng = np.random.default_rng(seed)
+    first = np.datetime64(start or datetime.datetime.now(), "us")
+    step = np.timedelta64(int(round(interval * 1e6)), "us")
+    with click.progressbar(length=sensors * readings, label="Generating measurements") as bar:
+        for name in names:
+            sensor = Sensor(name=name, model="testsensor")
+            db.session.add(sensor)
+            db.session.flush()
+            state = {}
+            pending = {}
+            for offset in range(0, readings, chunk_size):
+                times = first + step * np.arange(offset, min(offset + chunk_size, readings))
+                seconds = (times - np.datetime64(EPOCH, "us")) // np.timedelta64(1, "s")
+                values = generate_values(rng, distribution, seconds, state)
+                bulk_insert(Measurement.__table__, {
+                    "sensor_id": [sensor.id] * len(times),
+                    "value": values.tolist(),
+                    "time": bulk_time_values(times),
+                })
+                for rollup in ROLLUPS:
+                    summary = summarize_buckets(seconds, values, rollup.resolution)
+                    carried = pending.get(rollup)
+                    if carried is not None and carried[0] == summary[0][0]:
+                        summary[1][0] = min(summary[1][0], carried[1])
+                        summary[2][0] = max(summary[2][0], carried[2])
+                        summary[3][0] += carried[3]
+                        summary[4][0] += carried[4]
+                    elif carried is not None:
+                        insert_rollup_buckets(rollup, sensor.id, [[value] for value in carried])
+                    # the last bucket may continue in the next chunk
+                    pending[rollup] = [column[-1] for column in summary]
+                    insert_rollup_buckets(rollup, sensor.id, [column[:-1] for column in summary])
+                db.session.commit()
+                bar.update(len(times))
+            for rollup, carried in pending.items():
+                insert_rollup_buckets(rollup, sensor.id, [[value] for value in carried])
+            db.session.commit()
+
+@click.command("rebuild-rollups")
+@click.option("--chunk-size", default=ROLLUP_REBUILD_CHUNK, show_default=True,
+    help="measurements folded in per transaction"
+)
+@with_appcontext
+def rebuild_rollups_command(chunk_size):
+    """
+    Recomputes the rollup tables from the measurement table. The rollups of
+    the measurements that exist when the command starts are built in scratch
+    tables, reading measurements in id order in chunks that are committed
+    separately, so the backfill can run against a live database while the
+    live rollups keep being served and updated. A final transaction folds
+    in the measurements stored in the meantime and replaces the contents of
+    the live rollup tables with the scratch tables.
+    """
+
+    scratch = {rollup: rollup_scratch_table(rollup) for rollup in ROLLUPS}
+    for table in scratch.values():
+        table.drop(bind=db.engine, checkfirst=True)
+        table.create(bind=db.engine)
+
+    measurements = Measurement.__table__
+    upper = db.session.scalar(select(func.max(measurements.c.id))) or 0
+    db.session.commit()
+
+    def chunks(last_id, upper=None):
+        while True:
+            statement = select(
+                measurements.c.id, measurements.c.sensor_id,
+                measurements.c.value, measurements.c.time
+            ).where(measurements.c.id > last_id, measurements.c.sensor_id.is_not(None))
+            if upper is not None:
+                statement = statement.where(measurements.c.id <= upper)
+            rows = db.session.execute(
+                statement.order_by(measurements.c.id).limit(chunk_size)
+            ).mappings().all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1]["id"]
+
+    total = 0
+    for rows in chunks(0, upper):
+        update_rollups(rows, scratch)
+        db.session.commit()
+        total += len(rows)
+        click.echo("{} measurements folded into rollups".format(total))
+
+    # Deleting the live rows first makes this the writing transaction, so
+    # on SQLite no measurement can be stored between the catch-up reads and
+    # the copy. Rows of sensors deleted during the rebuild are not copied.
+    for rollup in ROLLUPS:
+        db.session.execute(delete(rollup.__table__))
+    for rows in chunks(upper):
+        update_rollups(rows, scratch)
+        total += len(rows)
+    for rollup, table in scratch.items():
+        db.session.execute(insert(rollup.__table__).from_select(
+            [column.name for column in table.columns],
+            select(table).where(table.c.sensor_id.in_(select(Sensor.id)))
+        ))
+    db.session.commit()
+    click.echo("{} measurements folded into rollups".format(total))
+
+    for table in scratch.values():
+        table.drop(bind=db.engine)
+
+def create_app(test_config=None):
+    """
+    Application factory. Configuration starts from DEFAULT_CONFIG and is
+    overridden by SENSORHUB_* environment variables (for example
+    SENSORHUB_SQLALCHEMY_DATABASE_URI or SENSORHUB_SQLALCHEMY_ENGINE_OPTIONS
+    as JSON) and finally by test_config. SENSORHUB_DATABASE_URI and
+    SENSORHUB_WRITE_BEHIND are accepted as short forms.
+
+    SQLite databases get the pool settings of their storage profile, server
+    databases get SERVER_ENGINE_OPTIONS, and explicit engine options win over
+    both.
+
+    : param dict test_config: configuration applied last
+    """
+
+    app = Flask(__name__, static_folder="static")
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_prefixed_env("SENSORHUB")
+    if "DATABASE_URI" in app.config:
+        app.config["SQLALCHEMY_DATABASE_URI"] = app.config.pop("DATABASE_URI")
+    if "WRITE_BEHIND" in app.config:
+        app.config["INGEST_WRITE_BEHIND"] = bool(app.config.pop("WRITE_BEHIND"))
+    if test_config is not None:
+        app.config.update(test_config)
+
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "sqlite":
+        engine_options = SERVER_ENGINE_OPTIONS
+    elif url.database in (None, "", ":memory:"):
+        engine_options = {}
+    else:
+        engine_options = SQLITE_PROFILES[app.config["SQLITE_PROFILE"]]["engine"]
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+        engine_options, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    )
+    db.init_app(app)
+
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", functools.partial(
+                set_sqlite_pragma,
+                pragmas=SQLITE_PROFILES[app.config["SQLITE_PROFILE"]]["pragmas"]
+            ))
+
+    queue = IngestQueue(
+        app,
+        app.config["INGEST_QUEUE_ROWS"],
+        app.config["INGEST_FLUSH_ROWS"],
+        app.config["INGEST_FLUSH_INTERVAL"],
+    )
+    atexit.register(queue.close)
+    hub = MeasurementHub(
+        app.config["SUBSCRIPTION_HISTORY"],
+        app.config["SUBSCRIPTION_KEEPALIVE"],
+    )
+    atexit.register(hub.close)
+    encoder = app.config["MASON_ENCODER"]
+    if encoder == "auto":
+        encoder = "orjson" if "orjson" in MASON_ENCODERS else "json"
+    app.extensions["sensorhub"] = {
+        "encode": MASON_ENCODERS[encoder],
+        "response_cache": ResponseCache(app.config["RESPONSE_CACHE_MAX_BYTES"]),
+        "ingest_queue": queue,
+        "hub": hub,
+        "metrics": RequestMetrics(),
+        "profiles": SlowestProfiles(
+            app.config["PROFILE_DIR"] or os.path.join(app.instance_path, "profiles"),
+            app.config["PROFILE_SLOWEST"]
+        ),
+    }
+
+    app.register_blueprint(api_bp)
+    app.register_blueprint(site_bp)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(add_partitions_command)
+    app.cli.add_command(migrate_indexes_command)
+    app.cli.add_command(check_query_plans_command)
+    app.cli.add_command(generate_test_data)
+    app.cli.add_command(rebuild_rollups_command)
+    return app
@@ -0,0 +1,577 @@
+"""
+ASGI serving mode for the sensor hub API in app.py. The read resources that
+take most of the traffic, SensorCollection, SensorItem and the Mason pages of
+MeasurementCollection, are served by coroutines that query the database
+through SQLAlchemy's asyncio extension, so a slow client or a slow query
+does not hold a thread. At most ASGI_DB_CONNECTIONS of them query the
+database at a time, in arrival order. Their representations are built by the same
+functions the Flask resources use, inside a Flask request context, and the
+responses go through the app's before and after request hooks, so caching,
+validators, Server-Timing and metrics work as they do under WSGI. Event
+streams of MeasurementSubscription are async generators woken up by the
+measurement hub, so an idle subscriber costs no thread.
+
+Every other request (writes, exports, aggregates and the site pages) is
+passed to the Flask app itself, which runs in a pool of
+ASGI_FALLBACK_THREADS threads. Request bodies are streamed to the thread as
+it reads them, so NDJSON uploads are validated and inserted while they
+arrive instead of being buffered first.
+
+The async engine needs an async driver for the configured database: aiosqlite
+for SQLite, asyncpg for PostgreSQL.
+
+Event streams only end when their client goes away or the measurement hub
+is closed, and ASGI servers wait for open requests before they run the
+lifespan shutdown, which closes the hub. Give the server a graceful shutdown
+timeout so that it cancels the streams that are still open after it, or it
+never stops while a subscriber is connected.
+
+Usage:
+    uvicorn --factory asgi:create_asgi_app --timeout-graceful-shutdown 5
+    SENSORHUB_DATABASE_URI=postgresql://localhost/sensorhub uvicorn --factory asgi:create_asgi_app --workers 4 --timeout-graceful-shutdown 5
+"""
+
+import asyncio
+import contextlib
+import functools
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, g, request
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import app as sensorhub
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+# chunks of a fallback response buffered between its thread and the event loop
+FALLBACK_QUEUE_CHUNKS = 8
+
+
+def create_async_engine_for(flask_app):
+    """
+    Creates an async engine for the database of a sensor hub app, with the
+    same pool options and, for SQLite, the same PRAGMAs as its sync engine.
+
+    : param Flask flask_app: app created by app.create_app
+    """
+
+    with flask_app.app_context():
+        url = sensorhub.db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError("No async driver is known for {} databases".format(backend))
+    engine = create_async_engine(
+        url.set(drivername=ASYNC_DRIVERS[backend]),
+        **flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    )
+    if backend == "sqlite":
+        event.listen(engine.sync_engine, "connect", functools.partial(
+            sensorhub.set_sqlite_pragma,
+            pragmas=sensorhub.SQLITE_PROFILES[flask_app.config["SQLITE_PROFILE"]]["pragmas"]
+        ))
+    return engine
+
+
+def build_environ(scope, body):
+    """
+    Builds the WSGI environ of an ASGI HTTP request, as PEP 3333 and the ASGI
+    specification describe it.
+
+    : param dict scope: the ASGI connection scope
+    : param body: readable binary stream of the request body, which must end
+        where the body ends
+    """
+
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+class RequestBody(io.RawIOBase):
+    """
+    Request body of a fallback request, read by its thread from a queue that
+    the event loop fills as the body arrives. None in the queue ends the
+    body.
+    """
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.chunk = b""
+        self.offset = 0
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset == len(self.chunk) and not self.done:
+            chunk = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+            if chunk is None:
+                self.done = True
+            else:
+                self.chunk = chunk
+                self.offset = 0
+        size = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:size] = self.chunk[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def start_message(status, headers):
+    return {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ],
+    }
+
+
+async def send_response(send, status, headers, chunks):
+    await send(start_message(status, headers))
+    for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_stream(receive, send, status, headers, chunks):
+    """
+    Sends a response whose body is an async iterator, until it ends or the
+    client goes away, and closes the iterator.
+    """
+
+    async def body():
+        await send(start_message(status, headers))
+        async for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    sender = asyncio.ensure_future(body())
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        watcher.cancel()
+        # the generator can only be closed once the sender has let go of it
+        error = (await asyncio.gather(sender, watcher, return_exceptions=True))[0]
+        await chunks.aclose()
+    if isinstance(error, Exception):
+        raise error
+
+
+class SensorhubASGI:
+    """
+    ASGI application serving a sensor hub Flask app. See the module
+    docstring.
+    """
+
+    def __init__(self, flask_app, engine, threads, connections):
+        """
+        : param Flask flask_app: app created by app.create_app
+        : param AsyncEngine engine: async engine for the app's database
+        : param int threads: size of the thread pool for fallback requests
+        : param int connections: database connections used at a time
+        """
+
+        self.flask_app = flask_app
+        self.engine = engine
+        self.slots = asyncio.Semaphore(connections)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="sensorhub-wsgi")
+        prefix = sensorhub.api_bp.name + "."
+        self.measurement_endpoint = prefix + sensorhub.MeasurementCollection.endpoint
+        self.views = {
+            prefix + sensorhub.SensorCollection.endpoint: self.sensor_collection,
+            prefix + sensorhub.SensorItem.endpoint: self.sensor_item,
+            prefix + sensorhub.MeasurementCollection.endpoint: self.measurement_collection,
+            prefix + sensorhub.MeasurementSubscription.endpoint: self.measurement_subscription,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise RuntimeError("Unsupported ASGI scope type {}".format(scope["type"]))
+
+        environ = build_environ(scope, io.BytesIO())
+        view, values = self.match(environ)
+        if view is None:
+            return await self.call_wsgi(environ, receive, send)
+
+        with self.flask_app.request_context(environ):
+            try:
+                await self.revalidate_cached()
+                response = self.flask_app.preprocess_request()
+                if response is None:
+                    response = await view(**values)
+                response = self.flask_app.process_response(response)
+            except Exception as e:
+                response = self.flask_app.handle_exception(e)
+        # closing the response runs its call_on_close callbacks, which
+        # record the request in the metrics and stop its profiler
+        try:
+            if hasattr(response.response, "__aiter__"):
+                headers = response.get_wsgi_headers(environ).to_wsgi_list()
+                await send_stream(receive, send, response.status_code, headers, response.response)
+            else:
+                chunks, status, headers = response.get_wsgi_response(environ)
+                await send_response(send, int(status.split(" ", 1)[0]), headers, chunks)
+        finally:
+            response.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.flask_app.extensions["sensorhub"]["hub"].close()
+                await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def match(self, environ):
+        """
+        Returns the coroutine serving the request and its URL variables, or
+        (None, None) if the request is left to the Flask app. This is decided
+        before any of the app's request hooks run, as they must run only
+        once. Binary exports of MeasurementCollection are left to the app.
+        """
+
+        if environ["REQUEST_METHOD"] != "GET":
+            return None, None
+        adapter = self.flask_app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, values = adapter.match()
+        except Exception:
+            return None, None
+        if endpoint == self.measurement_endpoint:
+            accept = parse_accept_header(environ.get("HTTP_ACCEPT"), MIMEAccept)
+            mimetype = accept.best_match(sensorhub.export_media_types(), default=sensorhub.MASON)
+            if mimetype != sensorhub.MASON:
+                return None, None
+        return self.views.get(endpoint), values
+
+    async def call_wsgi(self, environ, receive, send):
+        """
+        Runs the Flask app on a request in the thread pool, passing the
+        request body on as it arrives and sending the response as it is
+        produced. If the client goes away, the response iterable is closed
+        at its next chunk.
+        """
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(FALLBACK_QUEUE_CHUNKS)
+        body = asyncio.Queue(FALLBACK_QUEUE_CHUNKS)
+        disconnected = threading.Event()
+        environ["wsgi.input"] = io.BufferedReader(RequestBody(loop, body))
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put((int(status.split(" ", 1)[0]), headers))
+
+        def run():
+            try:
+                result = self.flask_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if disconnected.is_set():
+                            break
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            except BaseException as e:
+                put(e)
+            finally:
+                put(None)
+
+        async def watch():
+            receiving = True
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    break
+                if receiving:
+                    if message.get("body"):
+                        await body.put(message["body"])
+                    if not message.get("more_body"):
+                        receiving = False
+                        await body.put(None)
+            disconnected.set()
+            if receiving:
+                await body.put(None)
+
+        watcher = asyncio.ensure_future(watch())
+        loop.run_in_executor(self.executor, run)
+        started = False
+        item = True
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                if disconnected.is_set():
+                    continue
+                if isinstance(item, tuple):
+                    await send(start_message(*item))
+                    started = True
+                else:
+                    await send({"type": "http.response.body", "body": item, "more_body": True})
+            if started and not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.set()
+            watcher.cancel()
+            # the thread blocks until its chunks are taken off the queue
+            while item is not None:
+                item = await queue.get()
+
+    async def sensor_collection(self):
+        async with self.connect() as conn:
+            validators = await self.validators(conn, ("sensor", "location"))
+            not_modified = sensorhub.not_modified_response(validators)
+            if not_modified is not None:
+                return not_modified
+
+            sensorhub.cache_as("sensors")
+            rows = (await conn.execute(sensorhub.sensor_collection_statement())).all()
+
+        body = sensorhub.sensor_collection_body()
+        return sensorhub.add_validators(
+            Response(b"".join(body.iter_json(sensorhub.sensor_items(rows))), 200,
+                mimetype=sensorhub.MASON
+            ),
+            validators
+        )
+
+    async def sensor_item(self, sensor):
+        async with self.connect() as conn:
+            validators = await self.validators(conn, ("sensor", "location"))
+            not_modified = sensorhub.not_modified_response(validators)
+            if not_modified is not None:
+                return not_modified
+
+            sensorhub.cache_as("sensor:" + sensor)
+            row = (await conn.execute(sensorhub.sensor_item_statement(sensor))).first()
+        if row is None:
+            return sensorhub.create_error_response(404, "Not found",
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        body = sensorhub.sensor_item_body(*row)
+        return sensorhub.add_validators(
+            Response(sensorhub.dumps(body), 200, mimetype=sensorhub.MASON),
+            validators
+        )
+
+    async def measurement_collection(self, sensor):
+        """
+        Serves Mason pages. The binary exports never get here, see match.
+        """
+
+        async with self.connect() as conn:
+            validators = await self.validators(conn, (
+                "sensor", "measurement", sensorhub.sensor_measurement_version(sensor)
+            ), sensorhub.MASON)
+            not_modified = sensorhub.not_modified_response(validators)
+            if not_modified is not None:
+                return not_modified
+
+            sensor_id = (await conn.execute(
+                select(sensorhub.Sensor.id).where(sensorhub.Sensor.name == sensor)
+            )).scalar()
+            if sensor_id is None:
+                return sensorhub.create_error_response(404, "Not found",
+                    "No sensor was found with the name {}".format(sensor)
+                )
+
+            try:
+                args = sensorhub.measurement_page_args()
+            except ValueError:
+                return sensorhub.create_error_response(400, "Invalid query string value")
+
+            criteria = sensorhub.measurement_criteria(sensor_id, args)
+            mark = (await conn.execute(sensorhub.measurement_mark_statement())).scalar()
+            rows = (await conn.execute(sensorhub.measurement_page_statement(
+                criteria, args["start"], args["position"]
+            ))).all()
+            total = None
+            if args["with_total"]:
+                total = (await conn.execute(sensorhub.count_statement(criteria))).scalar()
+
+        page, has_prev, has_next = sensorhub.measurement_page(rows, args["start"], args["position"])
+        pinned = sensorhub.measurement_page_pin(page, has_next, args)
+        sensorhub.cache_as("sensor:" + sensor, "measurements:" + sensor, pinned=pinned,
+            late=None if pinned is None else sensorhub.late_measurement_statement(
+                criteria, pinned, mark
+            )
+        )
+        body = sensorhub.measurement_page_body(sensor, page, has_prev, has_next, args)
+        if total is not None:
+            body["total"] = total
+
+        response = Response(
+            b"".join(body.iter_json(sensorhub.measurement_items(page))), 200,
+            mimetype=sensorhub.MASON
+        )
+        response.vary.add("Accept")
+        return sensorhub.add_validators(response, validators)
+
+    async def measurement_subscription(self, sensor):
+        async with self.connect() as conn:
+            sensor_id = (await conn.execute(
+                select(sensorhub.Sensor.id).where(sensorhub.Sensor.name == sensor)
+            )).scalar()
+        if sensor_id is None:
+            return sensorhub.create_error_response(404, "Not found",
+                "No sensor was found with the name {}".format(sensor)
+            )
+
+        return sensorhub.event_stream_response(self.events(
+            self.flask_app.extensions["sensorhub"]["hub"],
+            sensor,
+            request.headers.get("Last-Event-ID"),
+            sensorhub.cached_url_for(sensorhub.MeasurementCollection, sensor=sensor)
+        ))
+
+    @staticmethod
+    async def events(hub, sensor, last_event_id, reload_href):
+        """
+        The async counterpart of MeasurementHub.stream, woken up from the
+        publishing thread instead of waiting in a thread of its own.
+        """
+
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # the loop has been closed
+                pass
+
+        subscription = hub.subscribe(sensor, last_event_id, reload_href, notify)
+        try:
+            yield subscription.opening()
+            while not hub.closing:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), hub.keepalive)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                frames = subscription.take()
+                yield b": keepalive\n\n" if frames is None else frames
+        finally:
+            subscription.close()
+
+    @contextlib.asynccontextmanager
+    async def connect(self):
+        """
+        Connects to the database once one of the connection slots is free.
+        Waiting requests get a slot in arrival order, which keeps a request
+        that has started from waiting behind every later one at each query.
+        """
+
+        async with self.slots:
+            async with self.engine.connect() as conn:
+                yield conn
+
+    @staticmethod
+    async def validators(conn, tables, variant=""):
+        rows = (await conn.execute(sensorhub.versions_statement(tables))).all()
+        g.response_validated = (tables, variant, sensorhub.table_versions(rows))
+        return sensorhub.versions_validators(rows, variant)
+
+    async def revalidate_cached(self):
+        """
+        Does the check of app.revalidate_cached_response for a cached
+        response of the request on an async connection, so that the app's
+        before request hook can serve the entry without querying.
+        """
+
+        cache = sensorhub.response_cache
+        if request.method != "GET" or not cache.max_bytes:
+            return
+        key = cache.request_key()
+        entry = cache.peek(key)
+        if entry is None or entry["validated"] is None:
+            return
+        async with self.connect() as conn:
+            rows = (await conn.execute(
+                sensorhub.versions_statement(entry["validated"][0])
+            )).all()
+            state = sensorhub.revalidation_state(entry, rows)
+            if state == "late" and (await conn.execute(entry["late"])).first() is None:
+                cache.replace(key, entry, sensorhub.revalidated_entry(entry, rows))
+            elif state != "current":
+                cache.replace(key, entry, None)
+        g.response_cache_revalidated = True
+
+
+def create_asgi_app(test_config=None):
+    """
+    Creates the sensor hub Flask app with app.create_app and wraps it for
+    ASGI servers.
+
+    : param dict test_config: configuration applied last
+    """
+
+    flask_app = sensorhub.create_app(test_config)
+    return SensorhubASGI(
+        flask_app,
+        create_async_engine_for(flask_app),
+        flask_app.config["ASGI_FALLBACK_THREADS"],
+        flask_app.config["ASGI_DB_CONNECTIONS"]
+    )
@@ -0,0 +1,972 @@
+"""
+Standalone benchmark harness for the sensor hub API in app.py. Each benchmark
+seeds a throwaway SQLite database, drives the Flask test client against it and
+prints a small table of results. Nothing here touches development.db.
+
+To compare storage backends, pass --database-uri to run the same benchmark
+against a server database instead, for example a local PostgreSQL started
+for the purpose. The sensor hub tables in that database are dropped and
+recreated for every run, so never point it at data you want to keep.
+
+The module under test can be swapped with --app, which makes it easy to compare
+two revisions of app.py: check the old revision out to some other path and run
+the same benchmark against both files.
+
+Usage:
+    python benchmarks.py pagination --counts 1000 10000 100000
+    python benchmarks.py --app /tmp/old/app.py pagination
+    python benchmarks.py sensor-item --requests 5000
+    python benchmarks.py export --rows 1000000
+    python benchmarks.py concurrency --profiles stock wal tuned
+    python benchmarks.py --database-uri postgresql://localhost/bench pagination
+    python benchmarks.py suite --output results.json
+    python benchmarks.py suite --compare baseline.json --threshold 0.2
+    python benchmarks.py validation --documents 10000
+    python benchmarks.py encoding
+    python benchmarks.py records --items 10000
+    python benchmarks.py --repeat 5 batch --sensors 500
+    python benchmarks.py subscriptions --subscribers 10 100 1000
+    python benchmarks.py serving --concurrency 10 100 1000 --duration 10
+"""
+
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import platform
+import shutil
+import subprocess
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import flask_sqlalchemy
+
+
+def load_app(args, **config):
+    """
+    Imports the sensor hub module from args.app and creates an app on an
+    empty database: a fresh file in a temporary directory, or the database
+    at args.database_uri after dropping its tables. Returns the imported
+    module and the app. Revisions from before the application factory ignore
+    config, and since they configure their database at import time, the
+    database URI is forced on them as Flask-SQLAlchemy initializes the app.
+
+    : param Namespace args: parsed command line arguments
+    """
+
+    if args.database_uri:
+        uri = args.database_uri
+    else:
+        tmpdir = tempfile.mkdtemp(prefix="sensorhub-bench-")
+        uri = "sqlite:///" + os.path.join(tmpdir, "bench.db")
+    os.environ["SENSORHUB_DATABASE_URI"] = uri
+    init_app = flask_sqlalchemy.SQLAlchemy.init_app
+
+    def init_app_on_bench_database(self, app):
+        app.config["SQLALCHEMY_DATABASE_URI"] = uri
+        init_app(self, app)
+
+    spec = importlib.util.spec_from_file_location("sensorhub_bench_app", args.app)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.app)))
+    flask_sqlalchemy.SQLAlchemy.init_app = init_app_on_bench_database
+    try:
+        spec.loader.exec_module(module)
+        if hasattr(module, "create_app"):
+            app = module.create_app(config)
+        else:
+            app = module.app
+    finally:
+        flask_sqlalchemy.SQLAlchemy.init_app = init_app
+    with app.app_context():
+        if args.database_uri:
+            module.db.drop_all()
+        module.db.create_all()
+    return module, app
+
+
+def seed_measurements(module, app, sensor_name, count, chunk_size=10000):
+    """
+    Creates a sensor and inserts count measurements for it at 10 second
+    intervals using Core bulk inserts. Returns the sensor name.
+    """
+
+    with app.app_context():
+        sensor = module.Sensor(name=sensor_name, model="benchmark")
+        module.db.session.add(sensor)
+        module.db.session.commit()
+        table = module.Measurement.__table__
+        now = datetime.datetime(2020, 1, 1)
+        interval = datetime.timedelta(seconds=10)
+        for offset in range(0, count, chunk_size):
+            rows = [
+                {
+                    "sensor_id": sensor.id,
+                    "value": float(i % 100),
+                    "time": now + interval * i,
+                }
+                for i in range(offset, min(offset + chunk_size, count))
+            ]
+            module.db.session.execute(table.insert(), rows)
+        module.db.session.commit()
+    return sensor_name
+
+
+def time_requests(client, url, repeat):
+    """
+    Sends the same GET request repeat times and returns the latencies in
+    milliseconds.
+    """
+
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        resp = client.get(url)
+        resp.get_data()
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert resp.status_code == 200, resp.status_code
+    return latencies
+
+
+def bench_pagination(args):
+    """
+    Measures measurement page latency against the number of stored
+    measurements, for the first page, a deep ?start= page and following the
+    next control from the deep page.
+    """
+
+    module, app = load_app(args)
+    client = app.test_client()
+    print("{:>10} {:>12} {:>12} {:>12}".format("rows", "first ms", "deep ms", "next ms"))
+    for count in args.counts:
+        name = seed_measurements(module, app, "bench-{}".format(count), count)
+        base = "/api/sensors/{}/measurements/".format(name)
+        deep = base + "?start={}".format(max(count - 2 * module.MEASUREMENT_PAGE_SIZE, 0))
+        first = statistics.median(time_requests(client, base, args.repeat))
+        deep_ms = statistics.median(time_requests(client, deep, args.repeat))
+        next_href = client.get(deep).json["@controls"].get("next", {}).get("href", deep)
+        next_ms = statistics.median(time_requests(client, next_href, args.repeat))
+        print("{:>10} {:>12.2f} {:>12.2f} {:>12.2f}".format(count, first, deep_ms, next_ms))
+
+
+def bench_sensor_item(args):
+    """
+    Measures the CPU time spent per SensorItem.get call, which is dominated
+    by building the item's controls and schemas. The resource method is
+    called directly inside a request context so that the test client's own
+    overhead is left out.
+    """
+
+    module, app = load_app(args)
+    client = app.test_client()
+    client.post("/api/sensors/", json={"name": "bench-sensor", "model": "benchmark"})
+    url = "/api/sensors/bench-sensor/"
+    resource = module.SensorItem()
+
+    samples = []
+    with app.test_request_context(url):
+        for i in range(100):
+            resource.get("bench-sensor").get_data()
+        for i in range(args.repeat):
+            start = time.process_time()
+            for j in range(args.requests):
+                resource.get("bench-sensor").get_data()
+            samples.append((time.process_time() - start) / args.requests * 1e6)
+    print("SensorItem.get CPU time per request: median {:.1f} us, best {:.1f} us".format(
+        statistics.median(samples), min(samples)
+    ))
+
+
+def bench_export(args):
+    """
+    Compares fetching a sensor's whole measurement history by following the
+    Mason next controls against the single .npy and Arrow stream exports.
+    """
+
+    module, app = load_app(args)
+    client = app.test_client()
+    name = seed_measurements(module, app, "bench-export", args.rows)
+    url = "/api/sensors/{}/measurements/".format(name)
+
+    print("{:>8} {:>12} {:>14} {:>10}".format("format", "seconds", "bytes", "rows"))
+    start = time.perf_counter()
+    size = rows = 0
+    href = url
+    while href:
+        resp = client.get(href)
+        size += len(resp.get_data())
+        body = resp.json
+        rows += len(body["items"])
+        href = body["@controls"].get("next", {}).get("href")
+    print("{:>8} {:>12.2f} {:>14} {:>10}".format("json", time.perf_counter() - start, size, rows))
+
+    for label, mimetype in (("npy", module.NPY), ("arrow", module.ARROW_STREAM)):
+        if mimetype not in module.export_media_types():
+            print("{:>8} {:>12}".format(label, "unavailable"))
+            continue
+        start = time.perf_counter()
+        resp = client.get(url, headers={"Accept": mimetype})
+        size = len(resp.get_data())
+        print("{:>8} {:>12.2f} {:>14} {:>10}".format(label, time.perf_counter() - start, size, args.rows))
+
+
+def bench_concurrency(args):
+    """
+    Runs reader and writer threads against one sensor for a fixed time under
+    each SQLite storage profile, and reports completed and failed requests
+    per second. Readers fetch the first measurement page, writers post small
+    batches of measurements. The response cache is disabled so that every
+    read reaches the database.
+    """
+
+    print("{:>8} {:>12} {:>12} {:>12} {:>12}".format(
+        "profile", "reads/s", "writes/s", "read errs", "write errs"
+    ))
+    for profile in args.profiles:
+        module, app = load_app(args, SQLITE_PROFILE=profile, RESPONSE_CACHE_MAX_BYTES=0)
+        name = seed_measurements(module, app, "bench-concurrency", args.rows)
+        url = "/api/sensors/{}/measurements/".format(name)
+        deadline = time.perf_counter() + args.duration
+        counts = {"read": [0, 0], "write": [0, 0]}
+        lock = threading.Lock()
+
+        def reader():
+            client = app.test_client()
+            while time.perf_counter() < deadline:
+                resp = client.get(url)
+                resp.get_data()
+                with lock:
+                    counts["read"][resp.status_code != 200] += 1
+
+        def writer(index):
+            client = app.test_client()
+            start = datetime.datetime(2030, 1, 1) + datetime.timedelta(days=index)
+            sent = 0
+            while time.perf_counter() < deadline:
+                batch = [
+                    {
+                        "value": 1.0,
+                        "time": (start + datetime.timedelta(seconds=sent + i)).strftime(
+                            "%Y-%m-%dT%H:%M:%SZ"
+                        ),
+                    }
+                    for i in range(args.batch)
+                ]
+                sent += args.batch
+                try:
+                    status = client.post(url, json=batch).status_code
+                except Exception:
+                    status = 500
+                with lock:
+                    counts["write"][status != 201] += 1
+
+        threads = [threading.Thread(target=reader) for i in range(args.readers)]
+        threads += [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print("{:>8} {:>12.1f} {:>12.1f} {:>12} {:>12}".format(
+            profile,
+            counts["read"][0] / args.duration,
+            counts["write"][0] / args.duration,
+            counts["read"][1],
+            counts["write"][1],
+        ))
+
+
+def summarize(latencies, elapsed, statements):
+    """
+    Reduces per request latencies (ms), the wall time of the whole case (s)
+    and the total SQL statement count into the figures stored in results.
+    """
+
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "mean_ms": statistics.fmean(latencies),
+        "p50_ms": cuts[49],
+        "p90_ms": cuts[89],
+        "p99_ms": cuts[98],
+        "max_ms": max(latencies),
+        "throughput_rps": len(latencies) / elapsed,
+        "sql_per_request": statements / len(latencies),
+    }
+
+
+def run_case(client, counter, calls, status):
+    """
+    Sends a list of (method, url, json body) requests in order and checks
+    that each returns the expected status. Returns the case summary.
+    """
+
+    latencies = []
+    counter["statements"] = 0
+    started = time.perf_counter()
+    for method, url, body in calls:
+        start = time.perf_counter()
+        resp = client.open(url, method=method, json=body)
+        resp.get_data()
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert resp.status_code == status, (method, url, resp.status_code)
+    return summarize(latencies, time.perf_counter() - started, counter["statements"])
+
+
+def git_revision(path):
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(path)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """
+    Runs every hot path of the API against a seeded dataset and reports
+    latency percentiles, throughput and SQL statements per request for
+    each. Results can be saved as JSON and compared against an earlier run
+    to catch regressions. The response cache is off unless --cache is given,
+    so that reads measure the resources themselves.
+    """
+
+    config = {} if args.cache else {"RESPONSE_CACHE_MAX_BYTES": 0}
+    module, app = load_app(args, **config)
+    client = app.test_client()
+    counter = {"statements": 0}
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        counter["statements"] += 1
+
+    name = seed_measurements(module, app, "bench-suite", args.readings)
+    with app.app_context():
+        module.db.session.execute(module.Sensor.__table__.insert(), [
+            {"name": "bench-sensor-{}".format(i), "model": "benchmark"}
+            for i in range(args.sensors - 1)
+        ])
+        module.db.session.commit()
+        module.event.listen(module.db.engine, "before_cursor_execute", count_statement)
+
+    n = args.requests
+    sensor_url = "/api/sensors/{}/".format(name)
+    measurements_url = sensor_url + "measurements/"
+    deep = max(args.readings - 2 * module.MEASUREMENT_PAGE_SIZE, 0)
+    cases = [
+        ("SensorCollection.get", [("GET", "/api/sensors/", None)] * n, 200),
+        ("SensorItem.get", [("GET", sensor_url, None)] * n, 200),
+        ("MeasurementCollection.get shallow", [("GET", measurements_url, None)] * n, 200),
+        ("MeasurementCollection.get deep",
+            [("GET", measurements_url + "?start={}".format(deep), None)] * n, 200),
+        ("SensorCollection.post", [
+            ("POST", "/api/sensors/", {"name": "bench-new-{}".format(i), "model": "benchmark"})
+            for i in range(n)
+        ], 201),
+        ("SensorItem.put", [
+            ("PUT", "/api/sensors/bench-new-{}/".format(i),
+                {"name": "bench-new-{}".format(i), "model": "benchmark-{}".format(i)})
+            for i in range(n)
+        ], 204),
+        ("SensorItem.delete", [
+            ("DELETE", "/api/sensors/bench-new-{}/".format(i), None) for i in range(n)
+        ], 204),
+    ]
+
+    results = {}
+    print("{:<36} {:>9} {:>9} {:>9} {:>10} {:>8}".format(
+        "case", "p50 ms", "p90 ms", "p99 ms", "req/s", "sql/req"
+    ))
+    for case, calls, status in cases:
+        if status == 200:
+            run_case(client, counter, calls[:args.warmup], status)
+        result = run_case(client, counter, calls, status)
+        results[case] = result
+        print("{:<36} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f} {:>8.1f}".format(
+            case, result["p50_ms"], result["p90_ms"], result["p99_ms"],
+            result["throughput_rps"], result["sql_per_request"]
+        ))
+
+    report = {
+        "app": os.path.abspath(args.app),
+        "revision": git_revision(args.app),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "database": args.database_uri or "sqlite (temporary file)",
+        "dataset": {"sensors": args.sensors, "readings": args.readings},
+        "cache": args.cache,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)["results"]
+        if compare_results(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+def compare_results(baseline, results, threshold):
+    """
+    Prints p50 latency and SQL statement changes against a baseline run.
+    Returns the cases whose p50 grew by more than threshold (a fraction) or
+    that run more SQL statements per request than before.
+    """
+
+    regressed = []
+    print()
+    print("{:<36} {:>12} {:>12} {:>8}".format("case", "base p50 ms", "p50 change", "sql"))
+    for case, result in results.items():
+        base = baseline.get(case)
+        if base is None:
+            continue
+        change = result["p50_ms"] / base["p50_ms"] - 1
+        sql = result["sql_per_request"] - base["sql_per_request"]
+        flag = change > threshold or sql > 0
+        if flag:
+            regressed.append(case)
+        print("{:<36} {:>12.2f} {:>+11.1%} {:>+8.1f}{}".format(
+            case, base["p50_ms"], change, sql, "  REGRESSION" if flag else ""
+        ))
+    return regressed
+
+
+def bench_validation(args):
+    """
+    Compares the cost of validating one write request body: calling
+    jsonschema.validate with the model schema on every request, as the
+    resources used to, against validators compiled once per schema with
+    jsonschema and, if installed, fastjsonschema.
+    """
+
+    module, app = load_app(args)
+    import jsonschema
+
+    documents = {
+        "Sensor": [
+            {"name": "sensor-{}".format(i), "model": "benchmark"}
+            for i in range(args.documents)
+        ],
+        "Measurement": [
+            {"value": i * 0.5, "time": "2020-01-01T00:00:00Z"}
+            for i in range(args.documents)
+        ],
+    }
+    print("{:<12} {:<26} {:>12}".format("model", "validator", "us per doc"))
+    for name, docs in documents.items():
+        schema = getattr(module, name).get_schema()
+        candidates = [
+            ("jsonschema.validate", lambda doc: jsonschema.validate(doc, schema)),
+            ("compiled jsonschema", module.compile_validator(schema, generate_code=False)),
+        ]
+        if getattr(module, "fastjsonschema", None) is not None:
+            candidates.append(("compiled fastjsonschema", module.compile_validator(schema)))
+        for label, validate in candidates:
+            samples = []
+            for i in range(args.repeat):
+                start = time.perf_counter()
+                for doc in docs:
+                    validate(doc)
+                samples.append((time.perf_counter() - start) / len(docs) * 1e6)
+            print("{:<12} {:<26} {:>12.2f}".format(name, label, min(samples)))
+
+
+def bench_encoding(args):
+    """
+    Measures the time to encode a 50 item measurement page and a 10k item
+    sensor list, built the way the resources build them, with every Mason
+    encoder the module offers. The baseline is the earlier path: stdlib
+    json.dumps per piece with datetime.isoformat() called per item.
+    """
+
+    module, app = load_app(args)
+    Builder = module.SensorhubBuilder
+    time0 = datetime.datetime(2020, 1, 1)
+
+    def measurement_page():
+        body = Builder()
+        body.add_namespace("senhub", module.LINK_RELATIONS_URL)
+        body.add_control("up", "/api/sensors/bench/")
+        body.add_control("self", "/api/sensors/bench/measurements/")
+        body.add_control("next", "/api/sensors/bench/measurements/?cursor=YXwyMDIw")
+        items = [
+            {"value": i * 0.37, "time": time0 + datetime.timedelta(seconds=10 * i)}
+            for i in range(module.MEASUREMENT_PAGE_SIZE)
+        ]
+        return body, items
+
+    def sensor_list():
+        body = Builder()
+        body.add_namespace("senhub", module.LINK_RELATIONS_URL)
+        body.add_control("self", "/api/sensors/")
+        items = []
+        for i in range(10000):
+            item = Builder(name="sensor-{}".format(i), model="benchmark", location=None)
+            item.add_control("self", "/api/sensors/sensor-{}/".format(i))
+            item.add_control("profile", href=module.SENSOR_PROFILE)
+            items.append(item)
+        return body, items
+
+    def baseline(body, items):
+        chunks = [json.dumps(body)[:-1], ', "items": [']
+        separator = ""
+        for item in items:
+            if isinstance(item.get("time"), datetime.datetime):
+                item = dict(item, time=item["time"].isoformat())
+            chunks.append(separator + json.dumps(item))
+            separator = ", "
+        chunks.append("]}")
+        return "".join(chunks).encode("utf-8")
+
+    def timed(encode, body, items):
+        samples = []
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            encode(body, items)
+            samples.append((time.perf_counter() - start) * 1000)
+        return min(samples)
+
+    print("{:<22} {:>14} {:>14}".format("encoder", "page ms", "10k list ms"))
+    payloads = (measurement_page(), sensor_list())
+    print("{:<22} {:>14.4f} {:>14.2f}".format(
+        "json.dumps + isoformat", *(timed(baseline, *payload) for payload in payloads)
+    ))
+    with app.app_context():
+        for name, encoder in module.MASON_ENCODERS.items():
+            app.extensions["sensorhub"]["encode"] = encoder
+            print("{:<22} {:>14.4f} {:>14.2f}".format(name, *(
+                timed(lambda body, items: b"".join(body.iter_json(items)), *payload)
+                for payload in payloads
+            )))
+
+
+def bench_records(args):
+    """
+    Compares collection items built as MasonBuilder dicts with MasonRecords
+    sharing a RecordTemplate: the peak memory held by a list of sensor items
+    and the time to build and encode it, with every Mason encoder the module
+    offers.
+    """
+
+    module, app = load_app(args)
+    if not hasattr(module, "MasonRecord"):
+        sys.exit("{} has no MasonRecord".format(args.app))
+    names = ["sensor-{}".format(i) for i in range(args.items)]
+    hrefs = ["/api/sensors/{}/".format(name) for name in names]
+
+    def builders():
+        items = []
+        for name, href in zip(names, hrefs):
+            item = module.SensorhubBuilder(name=name, model="benchmark", location=None)
+            item.add_control("self", href)
+            item.add_control("profile", module.SENSOR_PROFILE)
+            items.append(item)
+        return items
+
+    def records():
+        items = []
+        for name, href in zip(names, hrefs):
+            item = module.SENSOR_ITEM.record(name, "benchmark", None)
+            item.add_control("self", href)
+            items.append(item)
+        return items
+
+    def peak(build):
+        tracemalloc.start()
+        items = build()
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del items
+        return size / 1024 / 1024
+
+    print("{:<10} {:>10} {:<10} {:>14}".format("items", "peak MiB", "encoder", "build+encode ms"))
+    with app.app_context():
+        body = module.SensorhubBuilder()
+        body.add_namespace("senhub", module.LINK_RELATIONS_URL)
+        body.add_control("self", "/api/sensors/")
+        for label, build in (("builders", builders), ("records", records)):
+            size = peak(build)
+            for name, encoder in module.MASON_ENCODERS.items():
+                app.extensions["sensorhub"]["encode"] = encoder
+                samples = []
+                for i in range(args.repeat):
+                    start = time.perf_counter()
+                    b"".join(body.iter_json(build()))
+                    samples.append((time.perf_counter() - start) * 1000)
+                print("{:<10} {:>10.2f} {:<10} {:>14.2f}".format(label, size, name, min(samples)))
+
+
+def bench_batch(args):
+    """
+    Measures the time to create, rename and delete a number of sensors with
+    one request per sensor against one batch request per step, along with
+    the SQL statements each way takes.
+    """
+
+    module, app = load_app(args)
+    client = app.test_client()
+    statements = [0]
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    with app.app_context():
+        module.event.listen(module.db.engine, "before_cursor_execute", count_statement)
+
+    def singles(names):
+        for name in names:
+            resp = client.post("/api/sensors/", json={"name": name, "model": "benchmark"})
+            assert resp.status_code == 201, resp.status_code
+        for name in names:
+            resp = client.put("/api/sensors/{}/".format(name),
+                json={"name": name + "-r", "model": "renamed"}
+            )
+            assert resp.status_code == 204, resp.status_code
+        for name in names:
+            resp = client.delete("/api/sensors/{}-r/".format(name))
+            assert resp.status_code == 204, resp.status_code
+
+    def batches(names):
+        for ops in (
+            [{"op": "create", "name": name, "model": "benchmark"} for name in names],
+            [{"op": "update", "sensor": name, "name": name + "-r", "model": "renamed"} for name in names],
+            [{"op": "delete", "sensor": name + "-r"} for name in names],
+        ):
+            resp = client.post("/api/batch/sensors/", json=ops)
+            assert resp.status_code == 200, resp.status_code
+
+    print("{:<10} {:>12} {:>12}".format("mode", "ms", "statements"))
+    for label, run in (("single", singles), ("batch", batches)):
+        samples = []
+        for i in range(args.repeat):
+            names = ["bench-{}-{}-{}".format(label, i, j) for j in range(args.sensors)]
+            statements[0] = 0
+            start = time.perf_counter()
+            run(names)
+            samples.append((time.perf_counter() - start) * 1000)
+        print("{:<10} {:>12.1f} {:>12}".format(label, min(samples), statements[0]))
+
+
+def bench_subscriptions(args):
+    """
+    Measures the fan-out of the measurement hub: the time to publish a batch
+    and the time until every subscribed stream has received it, with one
+    thread consuming each stream the way a threaded worker would.
+    """
+
+    module, app = load_app(args)
+    print("{:>12} {:>12} {:>14} {:>14}".format(
+        "subscribers", "publish us", "delivery p50", "delivery max"
+    ))
+    with app.app_context():
+        for count in args.subscribers:
+            hub = module.MeasurementHub(history=16, keepalive=60.0)
+            received = []
+            lock = threading.Lock()
+            ready = threading.Barrier(count + 1)
+
+            def subscriber():
+                events = hub.stream("bench", None, "/")
+                next(events)
+                ready.wait()
+                for frame in events:
+                    with lock:
+                        received.append(time.perf_counter())
+
+            threads = [threading.Thread(target=subscriber, daemon=True) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            ready.wait()
+            time.sleep(0.1)
+
+            publish, delivery = [], []
+            rows = [{"value": 1.0, "time": datetime.datetime(2020, 1, 1)}] * 10
+            for i in range(args.repeat):
+                with lock:
+                    received.clear()
+                start = time.perf_counter()
+                hub.publish("bench", rows)
+                publish.append((time.perf_counter() - start) * 1e6)
+                while len(received) < count:
+                    time.sleep(0.001)
+                delivery.append((max(received) - start) * 1000)
+            hub.close()
+            print("{:>12} {:>12.1f} {:>12.2f}ms {:>12.2f}ms".format(
+                count, statistics.median(publish), statistics.median(delivery), max(delivery)
+            ))
+
+
+async def http_get(reader, writer, host, path):
+    """
+    Sends a GET request on a keep-alive HTTP/1.1 connection and reads the
+    whole response. Returns the status code.
+    """
+
+    writer.write("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(path, host).encode("latin-1"))
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    headers = dict(
+        (name.strip().lower(), value.strip())
+        for name, _, value in (line.partition(":") for line in lines[1:] if line)
+    )
+    if "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    if headers.get("connection") == "close":
+        raise ConnectionResetError("server closed the connection")
+    return status
+
+
+async def load(host, port, urls, connections, duration, timeout):
+    """
+    Keeps the given number of connections busy sending GET requests for the
+    given URLs in turn for duration seconds. Returns the latencies of the
+    successful requests in milliseconds and the number of failed ones.
+    """
+
+    latencies = []
+    failures = [0]
+    deadline = time.perf_counter() + duration
+
+    async def client(index):
+        conn = None
+        i = index
+        while time.perf_counter() < deadline:
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+                start = time.perf_counter()
+                status = await asyncio.wait_for(
+                    http_get(*conn, host, urls[i % len(urls)]), timeout
+                )
+                if status != 200:
+                    raise ValueError(status)
+                latencies.append((time.perf_counter() - start) * 1000)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                failures[0] += 1
+                if conn is not None:
+                    conn[1].close()
+                conn = None
+            i += 1
+        if conn is not None:
+            conn[1].close()
+
+    await asyncio.gather(*(client(i) for i in range(connections)))
+    return latencies, failures[0]
+
+
+def wait_for_port(host, port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit("server exited with status {}".format(process.returncode))
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    sys.exit("server did not start listening on port {}".format(port))
+
+
+def bench_serving(args):
+    """
+    Load-tests the API served the WSGI way, by gunicorn with a threaded
+    worker, and the ASGI way, by uvicorn running asgi.py, each as a single
+    process on the same seeded SQLite database with the response cache off.
+    For every number of concurrent keep-alive connections it reports the
+    throughput, p50 and p99 latency and failed requests over a mix of the
+    sensor list, a sensor and measurement pages. The load generator runs in
+    this process, so on a small machine it competes with the server for CPU.
+    """
+
+    module, app = load_app(args)
+    name = seed_measurements(module, app, "bench-serving", args.readings)
+    with app.app_context():
+        module.db.session.execute(module.Sensor.__table__.insert(), [
+            {"name": "bench-sensor-{}".format(i), "model": "benchmark"}
+            for i in range(args.sensors - 1)
+        ])
+        module.db.session.commit()
+    urls = [
+        "/api/sensors/",
+        "/api/sensors/{}/".format(name),
+        "/api/sensors/{}/measurements/".format(name),
+        "/api/sensors/{}/measurements/?start={}".format(name, args.readings // 2),
+    ]
+
+    host = "127.0.0.1"
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        port = sock.getsockname()[1]
+    servers = [
+        ("wsgi", "gunicorn", [
+            sys.executable, "-m", "gunicorn", "-k", "gthread", "-w", "1",
+            "--threads", str(args.threads), "--worker-connections", "10000",
+            "-b", "{}:{}".format(host, port), "app:create_app()",
+        ]),
+        ("asgi", "uvicorn", [
+            sys.executable, "-m", "uvicorn", "--factory", "asgi:create_asgi_app",
+            "--host", host, "--port", str(port), "--log-level", "warning",
+        ]),
+    ]
+    env = dict(os.environ, SENSORHUB_RESPONSE_CACHE_MAX_BYTES="0")
+    print("{:<6} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        "mode", "connections", "req/s", "p50 ms", "p99 ms", "failed"
+    ))
+    for label, server, command in servers:
+        if shutil.which(server) is None:
+            print("{:<6} {} is not installed, skipped".format(label, server))
+            continue
+        process = subprocess.Popen(
+            command, cwd=os.path.dirname(os.path.abspath(args.app)), env=env,
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            wait_for_port(host, port, process)
+            asyncio.run(load(host, port, urls, 4, 1.0, args.timeout))
+            for connections in args.concurrency:
+                latencies, failed = asyncio.run(
+                    load(host, port, urls, connections, args.duration, args.timeout)
+                )
+                latencies.sort()
+                p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("nan")
+                print("{:<6} {:>12} {:>10.0f} {:>10.1f} {:>10.1f} {:>10}".format(
+                    label, connections, len(latencies) / args.duration,
+                    statistics.median(latencies) if latencies else float("nan"),
+                    p99, failed
+                ))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Sensor hub benchmarks")
+    parser.add_argument("--app", default=os.path.join(here, "app.py"),
+        help="path to the app.py revision to benchmark"
+    )
+    parser.add_argument("--database-uri",
+        help="scratch server database to use instead of a temporary SQLite file"
+    )
+    parser.add_argument("--repeat", type=int, default=20,
+        help="requests per measurement point"
+    )
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    pagination = sub.add_parser("pagination", help=bench_pagination.__doc__)
+    pagination.add_argument("--counts", type=int, nargs="+",
+        default=[1000, 10000, 100000]
+    )
+    pagination.set_defaults(func=bench_pagination)
+
+    sensor_item = sub.add_parser("sensor-item", help=bench_sensor_item.__doc__)
+    sensor_item.add_argument("--requests", type=int, default=1000,
+        help="requests per sample"
+    )
+    sensor_item.set_defaults(func=bench_sensor_item)
+
+    export = sub.add_parser("export", help=bench_export.__doc__)
+    export.add_argument("--rows", type=int, default=1000000)
+    export.set_defaults(func=bench_export)
+
+    concurrency = sub.add_parser("concurrency", help=bench_concurrency.__doc__)
+    concurrency.add_argument("--profiles", nargs="+", default=["stock", "wal", "tuned"])
+    concurrency.add_argument("--readers", type=int, default=4)
+    concurrency.add_argument("--writers", type=int, default=4)
+    concurrency.add_argument("--batch", type=int, default=10,
+        help="measurements per write request"
+    )
+    concurrency.add_argument("--rows", type=int, default=100000,
+        help="measurements seeded before the run"
+    )
+    concurrency.add_argument("--duration", type=float, default=10.0,
+        help="seconds per profile"
+    )
+    concurrency.set_defaults(func=bench_concurrency)
+
+    suite = sub.add_parser("suite", help=bench_suite.__doc__)
+    suite.add_argument("--sensors", type=int, default=100,
+        help="sensors in the seeded dataset"
+    )
+    suite.add_argument("--readings", type=int, default=100000,
+        help="measurements of the sensor the measurement cases read"
+    )
+    suite.add_argument("--requests", type=int, default=200,
+        help="timed requests per case"
+    )
+    suite.add_argument("--warmup", type=int, default=20,
+        help="untimed requests before each read case"
+    )
+    suite.add_argument("--cache", action="store_true",
+        help="leave the response cache on"
+    )
+    suite.add_argument("--output", help="file to save the results in as JSON")
+    suite.add_argument("--compare", help="results file of a baseline run")
+    suite.add_argument("--threshold", type=float, default=0.2,
+        help="p50 slowdown counted as a regression, as a fraction"
+    )
+    suite.set_defaults(func=bench_suite)
+
+    validation = sub.add_parser("validation", help=bench_validation.__doc__)
+    validation.add_argument("--documents", type=int, default=2000,
+        help="documents validated per sample"
+    )
+    validation.set_defaults(func=bench_validation)
+
+    encoding = sub.add_parser("encoding", help=bench_encoding.__doc__)
+    encoding.set_defaults(func=bench_encoding)
+
+    records = sub.add_parser("records", help=bench_records.__doc__)
+    records.add_argument("--items", type=int, default=10000,
+        help="sensor items in the list"
+    )
+    records.set_defaults(func=bench_records)
+
+    batch = sub.add_parser("batch", help=bench_batch.__doc__)
+    batch.add_argument("--sensors", type=int, default=500,
+        help="sensors created, renamed and deleted per sample"
+    )
+    batch.set_defaults(func=bench_batch)
+
+    subscriptions = sub.add_parser("subscriptions", help=bench_subscriptions.__doc__)
+    subscriptions.add_argument("--subscribers", type=int, nargs="+", default=[10, 100, 1000])
+    subscriptions.set_defaults(func=bench_subscriptions)
+
+    serving = sub.add_parser("serving", help=bench_serving.__doc__)
+    serving.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 1000],
+        help="numbers of concurrent connections"
+    )
+    serving.add_argument("--duration", type=float, default=10.0,
+        help="seconds per concurrency level"
+    )
+    serving.add_argument("--threads", type=int, default=16,
+        help="threads of the gunicorn worker"
+    )
+    serving.add_argument("--timeout", type=float, default=10.0,
+        help="seconds before a request counts as failed"
+    )
+    serving.add_argument("--sensors", type=int, default=100)
+    serving.add_argument("--readings", type=int, default=100000)
+    serving.set_defaults(func=bench_serving)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
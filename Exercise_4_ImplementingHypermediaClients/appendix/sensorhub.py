@@ -20,7 +20,8 @@ SENSOR_PROFILE = "/profiles/sensor/"
 
 deployments = db.Table("deployments",
     db.Column("deployment_id", db.Integer, db.ForeignKey("deployment.id"), primary_key=True),
-    db.Column("sensor_id", db.Integer, db.ForeignKey("sensor.id"), primary_key=True)
+    db.Column("sensor_id", db.Integer, db.ForeignKey("sensor.id"), primary_key=True),
+    db.Index("ix_deployments_sensor_id", "sensor_id")
 )
 
 class Location(db.Model):
@@ -75,6 +76,10 @@ class Measurement(db.Model):
     time = db.Column(db.DateTime, nullable=False)
         
     sensor = db.relationship("Sensor", back_populates="measurements")
+
+    __table_args__ = (
+        db.Index("ix_measurement_sensor_time_id", "sensor_id", "time", "id"),
+    )
     
     @staticmethod
     def get_schema():
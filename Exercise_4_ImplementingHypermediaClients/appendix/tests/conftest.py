@@ -0,0 +1,98 @@
+"""
+Fixtures for the sensor hub tests. Every test that uses an app runs against
+a fresh SQLite database file and, when SENSORHUB_TEST_SERVER_URI points at a
+reachable server database (for example
+postgresql://localhost/sensorhub_test), against that database as well. The
+server database is emptied before and after each test, so do not point it
+at one that holds data you want to keep.
+
+Run from the appendix directory:
+    python -m pytest tests
+    SENSORHUB_TEST_SERVER_URI=postgresql://localhost/sensorhub_test python -m pytest tests
+"""
+
+import functools
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as sensorhub
+
+SERVER_URI = os.environ.get("SENSORHUB_TEST_SERVER_URI")
+
+
+@functools.lru_cache(maxsize=None)
+def server_unavailable():
+    """
+    Returns the reason the server database cannot be used, or None if it
+    can.
+    """
+
+    if not SERVER_URI:
+        return "SENSORHUB_TEST_SERVER_URI is not set"
+    try:
+        engine = create_engine(SERVER_URI)
+        with engine.connect():
+            pass
+        engine.dispose()
+    except Exception as e:
+        return "server database is not available: {}".format(e)
+    return None
+
+
+@pytest.fixture(params=["sqlite", "server"])
+def database_uri(request, tmp_path):
+    if request.param == "sqlite":
+        return "sqlite:///" + str(tmp_path / "test.db")
+    reason = server_unavailable()
+    if reason is not None:
+        pytest.skip(reason)
+    return SERVER_URI
+
+
+@pytest.fixture
+def make_app(database_uri):
+    """
+    Returns a function that creates an app on the test database with extra
+    configuration, and creates the tables unless create_tables is false,
+    which gives another app on the same data. Apps are shut down after the
+    test.
+    """
+
+    apps = []
+
+    def make(create_tables=True, **config):
+        app = sensorhub.create_app(dict(config,
+            SQLALCHEMY_DATABASE_URI=database_uri,
+            TESTING=True,
+        ))
+        if create_tables:
+            with app.app_context():
+                sensorhub.db.drop_all()
+                sensorhub.db.create_all()
+        apps.append(app)
+        return app
+
+    yield make
+
+    for app in apps:
+        app.extensions["sensorhub"]["ingest_queue"].close()
+        app.extensions["sensorhub"]["hub"].close()
+        with app.app_context():
+            if not database_uri.startswith("sqlite"):
+                sensorhub.db.drop_all()
+            sensorhub.db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
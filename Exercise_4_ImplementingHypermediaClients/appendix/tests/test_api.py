@@ -0,0 +1,302 @@
+import datetime
+import json
+
+from sqlalchemy import select
+
+import app as sensorhub
+
+SENSORS_URL = "/api/sensors/"
+START = datetime.datetime(2020, 1, 1)
+
+
+def timestamp(seconds):
+    return (START + datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def readings(times, value=None):
+    return [
+        {"value": float(t) if value is None else value, "time": timestamp(t)}
+        for t in times
+    ]
+
+
+def add_sensor(client, name="s1", model="x"):
+    response = client.post(SENSORS_URL, json={"name": name, "model": model})
+    assert response.status_code == 201
+    return SENSORS_URL + name + "/"
+
+
+def collect_pages(client, href):
+    items = []
+    while href:
+        body = client.get(href).get_json()
+        items.extend(body["items"])
+        href = body["@controls"].get("next", {}).get("href")
+    return items
+
+
+def test_sensor_lifecycle(client):
+    href = add_sensor(client)
+    body = client.get(href).get_json()
+    assert (body["name"], body["model"], body["location"]) == ("s1", "x", None)
+
+    assert client.post(SENSORS_URL, json={"name": "s1", "model": "y"}).status_code == 409
+    assert client.put(href, json={"name": "s2", "model": "y"}).status_code == 204
+    assert client.get(href).status_code == 404
+    assert client.get(SENSORS_URL + "s2/").get_json()["model"] == "y"
+
+    assert client.delete(SENSORS_URL + "s2/").status_code == 204
+    assert client.get(SENSORS_URL).get_json()["items"] == []
+
+
+def test_measurement_pages_follow_cursors(client):
+    href = add_sensor(client) + "measurements/"
+    assert client.post(href, json=readings(range(120))).status_code == 201
+
+    items = collect_pages(client, href)
+    assert [item["value"] for item in items] == [float(t) for t in range(120)]
+
+    second = client.get(client.get(href).get_json()["@controls"]["next"]["href"]).get_json()
+    first = client.get(second["@controls"]["prev"]["href"]).get_json()
+    assert first["items"] == items[:sensorhub.MEASUREMENT_PAGE_SIZE]
+
+
+def test_invalid_measurements_store_nothing(client):
+    href = add_sensor(client) + "measurements/"
+    response = client.post(href, json=readings(range(3)) + [{"value": "high"}])
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["index"] == 3
+    assert client.get(href).get_json()["items"] == []
+
+
+def test_ndjson_errors_point_at_lines(client):
+    href = add_sensor(client) + "measurements/"
+    lines = [json.dumps(reading) for reading in readings(range(3))]
+    lines[1:1] = ["", "{not json"]
+    response = client.post(href, data="\n".join(lines) + "\n",
+        content_type=sensorhub.NDJSON
+    )
+    assert response.status_code == 400
+    assert [error["line"] for error in response.get_json()["errors"]] == [3]
+
+    response = client.post(href, data="\n".join(lines[:1] + lines[3:]),
+        content_type=sensorhub.NDJSON
+    )
+    assert response.status_code == 201
+    assert len(client.get(href).get_json()["items"]) == 3
+
+
+def test_conditional_get(client):
+    add_sensor(client)
+    response = client.get(SENSORS_URL)
+    etag = response.headers["ETag"]
+    assert client.get(SENSORS_URL, headers={"If-None-Match": etag}).status_code == 304
+
+    add_sensor(client, "s2")
+    assert client.get(SENSORS_URL, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_measurement_validators_are_per_sensor(app, client):
+    first = add_sensor(client, "s1") + "measurements/"
+    second = add_sensor(client, "s2") + "measurements/"
+    etag = client.get(first).headers["ETag"]
+
+    client.post(second, json=readings(range(10)))
+    assert client.get(first, headers={"If-None-Match": etag}).status_code == 304
+    client.post(first, json=readings(range(10)))
+    assert client.get(first, headers={"If-None-Match": etag}).status_code == 200
+
+    with app.app_context():
+        names = sensorhub.db.session.scalars(select(sensorhub.TableVersion.table)).all()
+    assert {"measurement:1", "measurement:2"} <= set(names)
+    assert "measurement" not in names
+
+
+def test_late_measurement_refreshes_cached_page(client):
+    href = add_sensor(client) + "measurements/"
+    client.post(href, json=readings(range(0, 1200, 10)))
+    # only bodies that were read to the end are cached
+    client.get(href).get_data()
+    assert client.get(href).headers["X-Cache"] == "HIT"
+
+    # measurements after the page leave it cached
+    client.post(href, json=readings([5000], value=-1.0))
+    assert client.get(href).headers["X-Cache"] == "HIT"
+
+    # a late measurement inside the page does not
+    client.post(href, json=readings([105], value=-2.0))
+    response = client.get(href)
+    assert response.headers["X-Cache"] == "MISS"
+    assert {"value": -2.0, "time": timestamp(105)[:-1]} in response.get_json()["items"]
+
+
+def test_unread_streamed_bodies(client):
+    add_sensor(client)
+    for href in (SENSORS_URL, SENSORS_URL + "s1/", SENSORS_URL + "s1/measurements/"):
+        assert client.get(href).status_code == 200
+    assert client.post(SENSORS_URL, json={"name": "s2", "model": "x"}).status_code == 201
+    assert len(client.get(SENSORS_URL).get_json()["items"]) == 2
+
+
+def test_hub_forgets_sensors_without_subscribers(app, client):
+    href = add_sensor(client) + "measurements/"
+    hub = app.extensions["sensorhub"]["hub"]
+    subscriptions = [hub.subscribe("s1", None, href) for i in range(2)]
+    client.post(href, json=readings(range(3)))
+    assert hub.stats()["published"] == 1
+
+    for subscription in subscriptions:
+        assert hub.subscribed("s1")
+        subscription.close()
+    assert not hub.subscribed("s1")
+    client.post(href, json=readings(range(3, 6)))
+    assert hub.stats() == {"channels": 0, "subscribers": 0, "published": 1}
+
+
+def test_aggregates_match_measurements(client):
+    href = add_sensor(client) + "measurements/"
+    client.post(href, json=readings(range(0, 7200, 60)))
+    client.post(href, json=readings([30, 3630], value=1000.0))
+
+    body = client.get(href + "aggregate/", query_string={
+        "start": timestamp(0), "end": timestamp(7200), "bucket": "1h",
+    }).get_json()
+    assert body["items"] == [
+        {"start": timestamp(0), "min": 0.0, "max": 3540.0,
+            "avg": (sum(range(0, 3600, 60)) + 1000.0) / 61, "count": 61},
+        {"start": timestamp(3600), "min": 1000.0, "max": 7140.0,
+            "avg": (sum(range(3600, 7200, 60)) + 1000.0) / 61, "count": 61},
+    ]
+
+    # as expanded from the control template with only the window filled in
+    defaults = client.get(href + "aggregate/?start={}&end={}&bucket=&method=".format(
+        timestamp(0), timestamp(7200)
+    ))
+    assert defaults.status_code == 200
+    assert defaults.get_json()["items"] == body["items"]
+
+
+def test_rebuild_rollups(app, client):
+    href = add_sensor(client) + "measurements/"
+    client.post(href, json=readings(range(0, 7200, 45)))
+    with app.app_context():
+        before = {
+            rollup: sensorhub.db.session.execute(
+                select(rollup.__table__).order_by(rollup.bucket)
+            ).all()
+            for rollup in sensorhub.ROLLUPS
+        }
+
+    result = app.test_cli_runner().invoke(
+        sensorhub.rebuild_rollups_command, ["--chunk-size", "50"]
+    )
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        for rollup, rows in before.items():
+            assert sensorhub.db.session.execute(
+                select(rollup.__table__).order_by(rollup.bucket)
+            ).all() == rows
+
+
+def test_sensor_batch(client):
+    add_sensor(client, "a")
+    add_sensor(client, "b")
+    response = client.post("/api/batch/sensors/", json=[
+        {"op": "update", "sensor": "a", "name": "tmp", "model": "x"},
+        {"op": "update", "sensor": "b", "name": "a", "model": "x"},
+        {"op": "update", "sensor": "tmp", "name": "b", "model": "z"},
+        {"op": "delete", "sensor": "a"},
+        {"op": "create", "name": "c", "model": "y"},
+    ])
+    assert response.status_code == 200
+    items = client.get(SENSORS_URL).get_json()["items"]
+    assert sorted((item["name"], item["model"]) for item in items) == [("b", "z"), ("c", "y")]
+
+    response = client.post("/api/batch/sensors/", json=[
+        {"op": "create", "name": "d", "model": "y"},
+        {"op": "delete", "sensor": "nope"},
+    ])
+    assert response.status_code == 409
+    assert client.get(SENSORS_URL + "d/").status_code == 404
+
+
+def test_write_behind(make_app):
+    app = make_app(INGEST_WRITE_BEHIND=True, INGEST_QUEUE_ROWS=100)
+    client = app.test_client()
+    href = add_sensor(client) + "measurements/"
+
+    assert client.post(href, json=readings(range(60))).status_code == 202
+    assert client.post(href, json=readings(range(101))).status_code == 413
+    assert app.extensions["sensorhub"]["ingest_queue"].drain(10)
+    assert len(collect_pages(client, href)) == 60
+
+    metrics = client.get("/metrics").get_data(as_text=True).splitlines()
+    assert "# TYPE sensorhub_ingest_rejected_requests_total counter" in metrics
+    assert "sensorhub_ingest_written_rows_total 60" in metrics
+    assert "sensorhub_ingest_dropped_rows_total 0" in metrics
+
+
+def test_migrate_indexes_creates_missing_tables(app, client):
+    with app.app_context():
+        for table in [sensorhub.TableVersion.__table__] + [
+            rollup.__table__ for rollup in sensorhub.ROLLUPS
+        ]:
+            table.drop(sensorhub.db.engine)
+        sensorhub.db.engine.dispose()
+
+    result = app.test_cli_runner().invoke(sensorhub.migrate_indexes_command)
+    assert result.exit_code == 0, result.output
+    assert "rebuild-rollups" in result.output
+
+    href = add_sensor(client) + "measurements/"
+    assert client.post(href, json=readings(range(10))).status_code == 201
+    assert client.get(SENSORS_URL).status_code == 200
+
+
+def test_writes_elsewhere_refresh_cached_responses(make_app):
+    client = make_app().test_client()
+    other = make_app(create_tables=False).test_client()
+    href = add_sensor(client) + "measurements/"
+    client.post(href, json=readings(range(0, 1200, 10)))
+    client.get(SENSORS_URL).get_data()
+    etag = client.get(SENSORS_URL).headers["ETag"]
+
+    add_sensor(other, "s2")
+    response = client.get(SENSORS_URL, headers={"If-None-Match": etag})
+    assert (response.status_code, response.headers["X-Cache"]) == (200, "MISS")
+    assert len(response.get_json()["items"]) == 2
+
+    # the pinned page outlives measurements after it, but not a late one
+    client.get(href).get_data()
+    other.post(href, json=readings([5000], value=-1.0))
+    assert client.get(href).headers["X-Cache"] == "HIT"
+    other.post(href, json=readings([105], value=-2.0))
+    response = client.get(href)
+    assert response.headers["X-Cache"] == "MISS"
+    assert {"value": -2.0, "time": timestamp(105)[:-1]} in response.get_json()["items"]
+
+
+def test_sensor_listing_statement_count(make_app):
+    app = make_app()
+    app.debug = True
+    client = app.test_client()
+
+    def list_sensors(count):
+        # sensors are added behind the API's back, which the cache must notice
+        client.get(SENSORS_URL).get_data()
+        with app.app_context():
+            for i in range(len(sensorhub.Sensor.query.all()), count):
+                location = sensorhub.Location(name="room-{}".format(i))
+                sensorhub.db.session.add(sensorhub.Sensor(
+                    name="s{}".format(i), model="x", location=location
+                ))
+            sensorhub.db.session.commit()
+        response = client.get(SENSORS_URL)
+        assert response.headers["X-Cache"] == "MISS"
+        items = response.get_json()["items"]
+        assert len(items) == count
+        assert all(item["location"] == "room-" + item["name"][1:] for item in items)
+        return int(response.headers["X-SQL-Statements"])
+
+    assert list_sensors(1) == list_sensors(25)
+    assert int(client.get(SENSORS_URL + "s3/").headers["X-SQL-Statements"]) <= 2
@@ -0,0 +1,151 @@
+"""
+Tests of the ASGI server in asgi.py, driven with hand-built ASGI messages
+instead of a real server. Every app samples all requests for profiling, so
+a profiler that is left running shows up in sys.getprofile().
+"""
+
+import asyncio
+import json
+import sys
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+import asgi
+import app as sensorhub
+from test_api import SENSORS_URL, readings
+
+MEASUREMENTS_URL = SENSORS_URL + "s1/measurements/"
+
+
+@pytest.fixture
+def asgi_app(make_app, database_uri):
+    if not database_uri.startswith("sqlite"):
+        pytest.importorskip("asyncpg")
+    flask_app = make_app(PROFILE_SAMPLE_RATE=1.0)
+    engine = asgi.create_async_engine_for(flask_app)
+    yield asgi.SensorhubASGI(flask_app, engine, 2, 2)
+    asyncio.run(engine.dispose())
+
+
+async def call(app, method, path, body=b"", headers=(), until=None):
+    """
+    Sends one request to an ASGI app and returns the response as a dict of
+    status, headers and body. The client disconnects once the body so far
+    makes until return true, if until is given.
+    """
+
+    path, _, query = path.partition("?")
+    headers = [(name.lower(), value) for name, value in headers]
+    if body:
+        headers.append(("content-length", str(len(body))))
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(),
+        "root_path": "", "server": ("testserver", 80), "client": ("127.0.0.1", 1234),
+        "headers": [(name.encode(), value.encode()) for name, value in headers],
+    }
+    response = {"status": None, "headers": {}, "body": b""}
+    done = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {
+                name.decode(): value.decode() for name, value in message["headers"]
+            }
+        else:
+            response["body"] += message.get("body", b"")
+            if until is not None and until(response["body"]):
+                done.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        done.set()
+    return response
+
+
+def post_json(app, path, document):
+    return call(app, "POST", path, json.dumps(document).encode(),
+        [("Content-Type", "application/json")]
+    )
+
+
+def cache_stats(app):
+    return app.flask_app.extensions["sensorhub"]["response_cache"].stats()
+
+
+def requests_of(app, resource):
+    metrics = app.flask_app.extensions["sensorhub"]["metrics"]
+    return metrics.requests["api." + resource.endpoint, "GET", 200]
+
+
+def test_native_get(asgi_app):
+    async def run():
+        await post_json(asgi_app, SENSORS_URL, {"name": "s1", "model": "x"})
+        first = await call(asgi_app, "GET", SENSORS_URL)
+        second = await call(asgi_app, "GET", SENSORS_URL)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first["status"] == 200
+    assert [item["name"] for item in json.loads(first["body"])["items"]] == ["s1"]
+    assert (first["headers"]["x-cache"], second["headers"]["x-cache"]) == ("MISS", "HIT")
+    assert second["body"] == first["body"]
+    assert requests_of(asgi_app, sensorhub.SensorCollection) == 2
+    assert sys.getprofile() is None
+
+
+def test_export_falls_back_to_flask(asgi_app):
+    pytest.importorskip("numpy")
+
+    async def run():
+        await post_json(asgi_app, SENSORS_URL, {"name": "s1", "model": "x"})
+        await post_json(asgi_app, MEASUREMENTS_URL, readings(range(10)))
+        misses = cache_stats(asgi_app)["misses"]
+        response = await call(asgi_app, "GET", MEASUREMENTS_URL,
+            headers=[("Accept", sensorhub.NPY)]
+        )
+        return response, cache_stats(asgi_app)["misses"] - misses
+
+    response, misses = asyncio.run(run())
+    assert response["status"] == 200
+    assert response["headers"]["content-type"] == sensorhub.NPY
+    assert misses == 1
+    assert requests_of(asgi_app, sensorhub.MeasurementCollection) == 1
+    assert sys.getprofile() is None
+
+
+def test_event_stream(asgi_app):
+    stream_url = MEASUREMENTS_URL + "stream/"
+
+    async def run():
+        await post_json(asgi_app, SENSORS_URL, {"name": "s1", "model": "x"})
+        stream = asyncio.ensure_future(call(asgi_app, "GET", stream_url,
+            until=lambda body: b"event: measurements" in body
+        ))
+        hub = asgi_app.flask_app.extensions["sensorhub"]["hub"]
+        while not hub.stats()["subscribers"]:
+            await asyncio.sleep(0.01)
+        posted = await post_json(asgi_app, MEASUREMENTS_URL, readings(range(3)))
+        return posted, await asyncio.wait_for(stream, 5)
+
+    posted, response = asyncio.run(run())
+    assert posted["status"] == 201
+    assert response["status"] == 200
+    assert response["headers"]["content-type"].startswith("text/event-stream")
+    data = response["body"].split(b"data: ", 1)[1].split(b"\n", 1)[0]
+    assert [item["value"] for item in json.loads(data)] == [0.0, 1.0, 2.0]
+    assert requests_of(asgi_app, sensorhub.MeasurementSubscription) == 1
+    assert sys.getprofile() is None